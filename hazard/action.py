@@ -1,9 +1,13 @@
+from hazard.handler import load_policy, POLICY_PARALLEL
+
+
 class Action:
     def __init__(self, hazard):
         self._hazard = hazard
         self._id = None
         self._name = "(unknown)"
         self._code = ""
+        self._policy = POLICY_PARALLEL
 
     def id(self):
         return self._id
@@ -12,9 +16,14 @@ class Action:
         return self._name
 
     def load_json(self, json):
+        old_name = self._name
         self._id = json.get("id", self._id)
         self._name = json.get("name", self._name)
         self._code = json.get("code", self._code)
+        self._policy = load_policy(json, self._policy)
+        if self._name != old_name:
+            self._hazard._rename_action(self, old_name)
+        self._hazard._mark_changed(self)
 
     def to_json(self):
         return {
@@ -23,11 +32,17 @@ class Action:
             "id": self._id,
             "name": self._name,
             "code": self._code,
+            "policy": self._policy,
+        }
+
+    def _handlers(self):
+        return {
+            "code": self._code,
         }
 
     def remove(self):
-        del self._hazard._actions[self._id]
+        self._hazard.remove_action(self)
         self._hazard.save()
 
     async def invoke(self, data=None):
-        await self._hazard.execute(self._code)
+        await self._hazard.execute(self._code, self, "code", self._policy)
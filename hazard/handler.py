@@ -0,0 +1,114 @@
+import asyncio
+import logging
+
+from hazard.metrics import Histogram
+
+LOG = logging.getLogger("hazard")
+
+POLICY_PARALLEL = "parallel"
+POLICY_QUEUE = "queue"
+POLICY_RESTART = "restart"
+POLICY_DROP = "drop-if-running"
+
+POLICIES = (POLICY_PARALLEL, POLICY_QUEUE, POLICY_RESTART, POLICY_DROP)
+
+# Maximum number of handlers (across everything) running user code at once.
+MAX_RUNNING_HANDLERS = 32
+
+
+def load_policy(json, default=POLICY_PARALLEL):
+    policy = json.get("policy", default)
+    if policy not in POLICIES:
+        LOG.warning('Unknown handler policy "%s"', policy)
+        return default
+    return policy
+
+
+class HandlerRunner:
+    # Runs invocations of a single handler according to its policy.
+    def __init__(self, owner, name):
+        self._owner = owner
+        self._name = name
+        self._running = set()
+        self._queue = asyncio.Lock()
+        self._queued = 0
+        self._dropped = 0
+        self._restarted = 0
+        self._invocations = 0
+        self._errors = 0
+        self._compile_time = Histogram()
+        self._code_time = Histogram()
+        self._flush_time = Histogram()
+
+    def record_compile(self, t):
+        self._compile_time.observe(t)
+
+    def record(self, code_time, flush_time, failed):
+        self._code_time.observe(code_time)
+        self._flush_time.observe(flush_time)
+        if failed:
+            self._errors += 1
+
+    def record_error(self):
+        self._invocations += 1
+        self._errors += 1
+
+    async def run(self, policy, coro_fn):
+        self._invocations += 1
+
+        if policy == POLICY_DROP and self._running:
+            LOG.info('Dropping "%s/%s" (already running)', self._owner.name(), self._name)
+            self._dropped += 1
+            return False
+
+        if policy == POLICY_RESTART:
+            for task in self._running:
+                task.cancel()
+                self._restarted += 1
+            self._running.clear()
+
+        if policy == POLICY_QUEUE:
+            self._queued += 1
+            try:
+                await self._queue.acquire()
+            finally:
+                self._queued -= 1
+            try:
+                return await self._run_task(coro_fn)
+            finally:
+                self._queue.release()
+
+        return await self._run_task(coro_fn)
+
+    async def _run_task(self, coro_fn):
+        # Run in a separate task so that a restart can cancel the code
+        # without cancelling whoever invoked it.
+        task = asyncio.create_task(coro_fn())
+        self._running.add(task)
+        try:
+            await asyncio.wait((task,))
+        except asyncio.CancelledError:
+            task.cancel()
+            raise
+        finally:
+            self._running.discard(task)
+        if task.cancelled():
+            return False
+        return task.result()
+
+    def to_json(self):
+        return {
+            "owner_type": type(self._owner).__name__,
+            "owner": self._owner.id(),
+            "owner_name": self._owner.name(),
+            "handler": self._name,
+            "running": len(self._running),
+            "queued": self._queued,
+            "dropped": self._dropped,
+            "restarted": self._restarted,
+            "invocations": self._invocations,
+            "errors": self._errors,
+            "compile_time": self._compile_time.to_json(),
+            "code_time": self._code_time.to_json(),
+            "flush_time": self._flush_time.to_json(),
+        }
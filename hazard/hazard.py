@@ -1,55 +1,174 @@
+import time
+
+_import_start = time.monotonic()
+
 import aiohttp.web
+import async_timeout
+import asyncio
 import json
 import datetime
 import logging
-import urllib.request
+import os
 import collections
+import contextvars
 
 from hazard.thing import Thing, create_thing, create_thing_from_json
 from hazard.things import LIGHT_LEVELS, LIGHT_TEMPS
 
 from hazard.plugin import create_plugin
 import hazard.plugins
+import hazard.metrics
 
 from hazard.action import Action
+from hazard.handler import HandlerRunner, MAX_RUNNING_HANDLERS, POLICY_PARALLEL
+from hazard.http import HttpClient, HTTP_TIMEOUT
+from hazard.reconfigure import ReconfigureJob
+from hazard.store import JsonFileStore, JournalStore
+from hazard.zone import Zone
+
+IMPORT_TIME = time.monotonic() - _import_start
 
 LOG = logging.getLogger("hazard")
 
+SAVE_CALLS = hazard.metrics.counter("hazard_save_calls_total", "Calls to Hazard.save.")
+SAVE_WRITES = hazard.metrics.counter("hazard_save_writes_total", "Config writes to disk.")
+SAVE_DURATION = hazard.metrics.histogram("hazard_save_seconds", "Time to serialize and write the config.")
+EXECUTES = hazard.metrics.counter("hazard_executes_total", "Handler code executions.")
+EXECUTE_ERRORS = hazard.metrics.counter("hazard_execute_errors_total", "Handler code executions that raised or failed to compile.")
+EXECUTE_DURATION = hazard.metrics.histogram("hazard_execute_seconds", "Handler code execution time, including flush.")
+
+# Set while running handler code (and inherited by tasks it creates), so that
+# handlers invoked from other handlers don't take a second slot.
+_IN_HANDLER = contextvars.ContextVar("hazard_in_handler", default=False)
+
+CONFIG_PATH = os.environ.get("HAZARD_CONFIG", os.path.expanduser("~/.hazard"))
+
+# Use the append-only JournalStore rather than rewriting a single JSON file.
+CONFIG_JOURNAL = os.environ.get("HAZARD_JOURNAL", "") not in ("", "0")
+
+# Seconds to allow each plugin or thing to start.
+STARTUP_TIMEOUT = 30
+
+# Seconds to wait after a change before writing the config, so that bursts of
+# changes are coalesced into a single write.
+SAVE_DELAY = 2
+
+# Maximum number of compiled handlers to keep around.
+CODE_CACHE_SIZE = 256
+
+CODE_HEADER = """
+async def __code(__status):
+    import sys
+    import asyncio
+    import datetime
+    import time
+    import os
+
+    result = True
+
+    def cancel():
+        nonlocal result
+        result = False
+
+    try:
+"""
+
+CODE_FOOTER = """
+        pass
+    except Exception as e:
+        import sys
+        t, v, tb = sys.exc_info()
+        import logging
+        import traceback
+        logging.getLogger('hazard').error("Error in event handler: {}: {}\\n{}".format(t.__name__, v, ''.join(traceback.format_tb(tb))))
+        __status["failed"] = True
+
+    return result
+"""
+
 
 class Hazard:
-    def __init__(self):
+    def __init__(self, path=CONFIG_PATH, journal=CONFIG_JOURNAL, save_delay=SAVE_DELAY):
         self._plugins = {}
         self._zones = {}
         self._things = {}
         self._actions = {}
+        self._things_by_name = {}
+        self._things_by_type = {}
+        # Bumped whenever things are added, removed or renamed, so that cached
+        # name lookups (e.g. LightGroup members) know to refresh.
+        self._things_version = 0
+        self._actions_by_name = {}
+        # Global change version, and the version and cached to_json() bytes
+        # of each thing and action. Changed objects are re-serialized (once
+        # per loop iteration) and only bump the version if their JSON differs.
+        self._version = 0
+        self._serialized = {}
+        self._changed = set()
+        self._changed_handle = None
+        self._listeners = []
+        # (field, value) -> {id: thing} for json_type and each feature,
+        # maintained from each thing's JSON as it changes. Zone membership is
+        # kept by the Zone objects in _zones.
+        self._thing_index = {}
+        self._thing_index_keys = {}
+        self._thing_zones = {}
         self._tseq = 10
         self._aseq = 1
         self._state = collections.defaultdict(lambda: None)
+        self._code_cache = collections.OrderedDict()
+        self._globals = self._make_globals()
+        if journal:
+            self._store = JournalStore(path)
+        else:
+            self._store = JsonFileStore(path)
+        self._save_delay = save_delay
+        self._save_dirty = False
+        self._save_handle = None
+        self._save_lock = asyncio.Lock()
+        # Things and actions (-> removed) whose JSON has changed since the
+        # last write, so that only they need to be given to the store. Until
+        # the store has been read or fully written, it needs the full config.
+        self._unsaved = {}
+        self._save_full = True
+        # Background tasks, kept here so they aren't garbage collected
+        # before they finish.
+        self._tasks = set()
+        self._timings = {"import": IMPORT_TIME}
+        self._reconfigure_job = None
+        self._http = HttpClient()
+        self._runners = {}
+        self._handler_limit = asyncio.Semaphore(MAX_RUNNING_HANDLERS)
+        self._handlers_running = 0
 
     def load(self):
+        start = time.monotonic()
         # try:
-        with open("/home/jimmo/.hazard", "r") as f:
-            config = json.load(f)
-            for p in config.get("plugins", []):
-                LOG.debug("Plugin: {}".format(p))
-                p = create_plugin(p, self)
-                self._plugins[type(p).__name__] = p
-            for t in config.get("things", []):
-                LOG.debug("Thing: {}".format(t))
-                t = create_thing_from_json(t, self)
-                self._tseq = max(t.id() + 1, self._tseq)
-                self._things[t.id()] = t
-            for a in config.get("actions", []):
-                LOG.debug("Action: {}".format(a))
-                action = Action(self)
-                action.load_json(a)
-                self._aseq = max(action.id() + 1, self._aseq)
-                self._actions[action.id()] = action
-            self._state.update(config.get("state", {}))
+        config = self._store.read()
+        self._save_full = False
+        for p in config.get("plugins", []):
+            LOG.debug("Plugin: {}".format(p))
+            p = create_plugin(p, self)
+            self._plugins[type(p).__name__] = p
+        for t in config.get("things", []):
+            LOG.debug("Thing: {}".format(t))
+            t = create_thing_from_json(t, self)
+            self._tseq = max(t.id() + 1, self._tseq)
+            self._add_thing(t)
+        for a in config.get("actions", []):
+            LOG.debug("Action: {}".format(a))
+            action = Action(self)
+            action.load_json(a)
+            self._aseq = max(action.id() + 1, self._aseq)
+            self._add_action(action)
+        self._state.update(config.get("state", {}))
+        for obj in list(self._things.values()) + list(self._actions.values()):
+            self.check_handlers(obj)
         # except FileNotFoundError:
         #  pass
         # except json.decoder.JSONDecodeError:
         #  pass
+        self._timings["config"] = time.monotonic() - start
 
         if "RestPlugin" not in self._plugins:
             LOG.warning("Creating default rest plugin")
@@ -60,136 +179,430 @@ class Hazard:
             self._plugins["AppPlugin"] = hazard.plugins.AppPlugin(self)
             self.save()
 
+    def _thing_dependencies(self, thing):
+        # Things provided by a plugin live in that plugin's package (e.g.
+        # hazard.plugins.zigbee2mqtt.things), so depend on that plugin.
+        module = type(thing).__module__
+        deps = []
+        for name, p in self._plugins.items():
+            package = type(p).__module__.rpartition(".")[0]
+            if module.startswith(package + "."):
+                deps.append(name)
+        return deps
+
+    async def _start_component(self, name, coro, timings):
+        start = time.monotonic()
+        try:
+            async with async_timeout.timeout(STARTUP_TIMEOUT):
+                await coro
+        except asyncio.TimeoutError:
+            LOG.error('Timeout starting "%s"', name)
+        except Exception:
+            LOG.exception('Error starting "%s"', name)
+        timings[name] = time.monotonic() - start
+
     async def start(self):
-        for p in self._plugins.values():
-            await p.start()
-        for t in self._things.values():
-            await t.start()
+        start = time.monotonic()
+        started = {name: asyncio.Event() for name in self._plugins}
+        timings = {}
+
+        async def start_plugin(name, p):
+            for dep in p._dependencies():
+                if dep in started:
+                    await started[dep].wait()
+            await self._start_component("plugin:" + name, p.start(), timings)
+            started[name].set()
+
+        async def start_thing(t):
+            for dep in self._thing_dependencies(t):
+                await started[dep].wait()
+            await self._start_component("thing:" + t.name(), t.start(), timings)
+
+        await asyncio.gather(
+            *(start_plugin(name, p) for name, p in self._plugins.items()),
+            *(start_thing(t) for t in self._things.values()),
+        )
+
+        self._timings["start"] = time.monotonic() - start
+        self._timings.update(timings)
+        LOG.info(
+            "Startup timings:\n%s",
+            "\n".join(
+                "  {:>8.3f}s {}".format(v, k)
+                for k, v in sorted(self._timings.items(), key=lambda kv: -kv[1])
+            ),
+        )
 
     async def stop(self):
         for p in self._plugins.values():
             await p.stop()
         for t in self._things.values():
             await t.stop()
-
-    def save(self):
-        config = {
+        await self._http.close()
+        await self.flush()
+
+    def _config_json(self):
+        config = self._config_changes_json()
+        config.update({
+            "things": [self.serialized(t)[2] for t in sorted(self._things.values(), key=lambda t: (type(t).__name__, t._name))],
+            "actions": [self.serialized(a)[2] for a in self._actions.values()],
+        })
+        return config
+
+    def _config_changes_json(self):
+        # Just the plugins and state -- things and actions are taken from
+        # _unsaved (or the serialization cache for a full write).
+        return {
             "plugins": [p.to_json() for p in self._plugins.values()],
-            "things": [t.to_json() for t in sorted(self._things.values(), key=lambda t: (type(t).__name__, t._name))],
-            "actions": [a.to_json() for a in self._actions.values()],
-            "state": self._state,
+            "state": dict(self._state),
+        }
+
+    def _take_unsaved(self):
+        self.update_versions()
+        changed = {
+            ("action" if isinstance(obj, Action) else "thing", obj.id()): None if removed else self._serialized[obj][2]
+            for obj, removed in self._unsaved.items()
         }
-        with open("/home/jimmo/.hazard", "w") as f:
-            json.dump(config, f, indent=2)
+        self._unsaved = {}
+        return changed
+
+    def _write_full(self):
+        # Synchronous, for use before the loop is running.
+        self._unsaved = {}
+        self._store.write(self._config_json())
+        self._save_full = False
+
+    def save(self):
+        # Only marks the config dirty -- the actual write happens later (off
+        # the event loop) so this is cheap enough to call from frame handlers.
+        SAVE_CALLS.inc()
+        self._save_dirty = True
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Not running yet (e.g. during load), so just write it now.
+            self._save_dirty = False
+            self._write_full()
+            return
+        self._schedule_save(loop)
+
+    def _schedule_save(self, loop):
+        if self._save_handle is None:
+            self._save_handle = loop.call_later(self._save_delay, self._on_save_timer)
+
+    def _create_task(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    def _on_save_timer(self):
+        self._save_handle = None
+        self._create_task(self.flush())
+
+    async def flush(self):
+        if self._save_handle:
+            self._save_handle.cancel()
+            self._save_handle = None
+        async with self._save_lock:
+            if not self._save_dirty:
+                return
+            self._save_dirty = False
+            start = time.monotonic()
+            try:
+                # Snapshot on the loop, encode and write in the executor.
+                # Only the things and actions that changed are passed to the
+                # store.
+                if self._save_full:
+                    write, args = self._store.write, (self._config_json(),)
+                    self._unsaved = {}
+                else:
+                    write, args = self._store.write_changes, (self._config_changes_json(), self._take_unsaved())
+                self._save_full = False
+                await asyncio.get_running_loop().run_in_executor(None, write, *args)
+                SAVE_WRITES.inc()
+            except Exception:
+                LOG.exception("Failed to save config")
+                self._save_dirty = True
+                # The changes taken from _unsaved might not have been
+                # written, so write everything next time (and try again
+                # later rather than waiting for the next save()).
+                self._save_full = True
+                self._schedule_save(asyncio.get_running_loop())
+            SAVE_DURATION.observe(time.monotonic() - start)
 
     def find_plugin(self, cls):
         if not isinstance(cls, str):
             cls = cls.__name__
         return self._plugins[cls]
 
-    def find_thing(self, name):
+    def _add_thing(self, thing):
+        self._things_version += 1
+        self._things[thing.id()] = thing
+        self._things_by_name.setdefault(thing.name(), thing)
+        for cls in type(thing).__mro__:
+            self._things_by_type.setdefault(cls, {})[thing.id()] = thing
+        self._mark_changed(thing)
+
+    def _mark_changed(self, obj):
+        self._changed.add(obj)
+        if self._changed_handle is None:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                # Picked up by the next update_versions().
+                return
+            self._changed_handle = loop.call_soon(self.update_versions)
+
+    def _is_registered(self, obj):
+        objs = self._actions if isinstance(obj, Action) else self._things
+        return objs.get(obj.id(), None) is obj
+
+    def _index_thing(self, thing, thing_json):
+        zone = thing_json.get("zone", None)
+        old_zone = self._thing_zones.get(thing, None)
+        if old_zone is not None and old_zone.name() != zone:
+            old_zone._remove(thing)
+        self._thing_zones[thing] = self._zone(zone)
+        self._thing_zones[thing]._update(thing, thing_json)
+
+        keys = {("json_type", thing_json.get("json_type", None))}
+        keys.update(("feature", f) for f in thing_json.get("features", []))
+        old_keys = self._thing_index_keys.get(thing, set())
+        for key in old_keys - keys:
+            self._unindex_key(thing, key)
+        for key in keys - old_keys:
+            self._thing_index.setdefault(key, {})[thing.id()] = thing
+        self._thing_index_keys[thing] = keys
+
+    def _unindex_key(self, thing, key):
+        things = self._thing_index[key]
+        del things[thing.id()]
+        if not things:
+            del self._thing_index[key]
+
+    def _unindex_thing(self, thing):
+        zone = self._thing_zones.pop(thing, None)
+        if zone:
+            zone._remove(thing)
+        for key in self._thing_index_keys.pop(thing, ()):
+            self._unindex_key(thing, key)
+
+    def _zone(self, name):
+        # Zones are created when a thing is first seen in them, and stay
+        # registered so that references held by handler code remain valid.
+        if name not in self._zones:
+            self._zones[name] = Zone(self, name)
+        return self._zones[name]
+
+    def zone(self, name):
+        # Brings the aggregates up to date with any pending changes first.
+        self.update_versions()
+        z = self._zones.get(name, None)
+        if z is None:
+            raise ValueError('Zone "{}" not found'.format(name))
+        return z
+
+    def all_zones(self):
+        self.update_versions()
+        return list(self._zones.values())
+
+    def _removed(self, obj):
+        if not isinstance(obj, Action):
+            self._unindex_thing(obj)
+        self._changed.discard(obj)
+        self._serialized.pop(obj, None)
+        self._unsaved[obj] = True
+        self._version += 1
+        self._notify(obj, removed=True)
+
+    def add_listener(self, fn):
+        # fn(obj, version, removed) is called for every thing or action whose
+        # JSON changes, or that is added or removed.
+        self._listeners.append(fn)
+
+    def remove_listener(self, fn):
+        if fn in self._listeners:
+            self._listeners.remove(fn)
+
+    def _notify(self, obj, removed=False):
+        for fn in list(self._listeners):
+            try:
+                fn(obj, self._version, removed)
+            except Exception:
+                LOG.exception("Error in change listener")
+
+    def update_versions(self):
+        # Re-serialize anything marked as changed, and return the current
+        # global version.
+        if self._changed_handle:
+            self._changed_handle.cancel()
+            self._changed_handle = None
+        changed, self._changed = self._changed, set()
+        for obj in changed:
+            if not self._is_registered(obj):
+                continue
+            obj_json = obj.to_json()
+            data = json.dumps(obj_json).encode()
+            cached = self._serialized.get(obj, None)
+            if cached and cached[1] == data:
+                continue
+            self._version += 1
+            self._serialized[obj] = (self._version, data, obj_json)
+            self._unsaved[obj] = False
+            if not isinstance(obj, Action):
+                self._index_thing(obj, obj_json)
+            self._notify(obj)
+        return self._version
+
+    def serialized(self, obj):
+        # Returns (version, bytes, json) for a thing or action. The json dict
+        # is shared, so must not be modified.
+        if obj in self._changed or obj not in self._serialized:
+            self._changed.add(obj)
+            self.update_versions()
+        return self._serialized[obj]
+
+    def _unindex_name(self, index, objs, obj, name):
+        if index.get(name, None) is not obj:
+            return
+        del index[name]
+        # Another object might share the same name.
+        for o in objs.values():
+            if o is not obj and o.name() == name:
+                index[name] = o
+                break
+
+    def _rename_thing(self, thing, old_name):
+        if self._things.get(thing.id(), None) is not thing:
+            return
+        self._things_version += 1
+        self._unindex_name(self._things_by_name, self._things, thing, old_name)
+        self._things_by_name.setdefault(thing.name(), thing)
+
+    def _reindex_things(self):
+        things_by_name = {}
         for t in self._things.values():
-            if t.name() == name:
-                return t
-        raise ValueError('Thing "{}" not found'.format(name))
+            things_by_name.setdefault(t.name(), t)
+        if things_by_name != self._things_by_name:
+            self._things_version += 1
+            self._things_by_name = things_by_name
+
+    def find_thing(self, name):
+        # Renames are tracked by Thing.__setattr__, so a miss is just a miss.
+        # A stale entry shouldn't happen, but is repaired if it does.
+        t = self._things_by_name.get(name, None)
+        if t is not None and t.name() != name:
+            self._reindex_things()
+            t = self._things_by_name.get(name, None)
+        if t is None:
+            raise ValueError('Thing "{}" not found'.format(name))
+        return t
 
     def all_things(self):
         return self._things.values()
 
     def find_things(self, thing_type):
-        return [t for t in self._things.values() if isinstance(t, thing_type)]
+        return list(self._things_by_type.get(thing_type, {}).values())
+
+    def query_things(self, zone=None, type=None, json_type=None, feature=None):
+        # Things matching all of the given criteria, in id order. type is a
+        # class name and also matches subclasses.
+        self.update_versions()
+        candidates = []
+        if type is not None:
+            cls = next((c for c in self._things_by_type if c.__name__ == type), None)
+            candidates.append(self._things_by_type.get(cls, {}))
+        if zone is not None:
+            candidates.append(self._zones[zone]._things if zone in self._zones else {})
+        for field, value in (("json_type", json_type), ("feature", feature)):
+            if value is not None:
+                candidates.append(self._thing_index.get((field, value), {}))
+        if not candidates:
+            return list(self._things.values())
+        candidates.sort(key=len)
+        ids = [i for i in candidates[0] if all(i in c for c in candidates[1:])]
+        return [self._things[i] for i in sorted(ids)]
+
+    def _add_action(self, action):
+        self._actions[action.id()] = action
+        self._actions_by_name.setdefault(action.name(), action)
+        self._mark_changed(action)
+
+    def _rename_action(self, action, old_name):
+        if self._actions.get(action.id(), None) is not action:
+            return
+        self._unindex_name(self._actions_by_name, self._actions, action, old_name)
+        self._actions_by_name.setdefault(action.name(), action)
 
     def find_action(self, name):
-        for a in self._actions.values():
-            if a.name() == name:
-                return a
-        raise ValueError('Action "{}" not found'.format(name))
+        a = self._actions_by_name.get(name, None)
+        if a is None:
+            raise ValueError('Action "{}" not found'.format(name))
+        return a
+
+    def remove_action(self, action):
+        del self._actions[action.id()]
+        self._unindex_name(self._actions_by_name, self._actions, action, action.name())
+        self.discard_code(action._code)
+        self._discard_runners(action)
+        self._removed(action)
 
     def remove_thing(self, thing):
+        self._things_version += 1
         del self._things[thing.id()]
+        self._unindex_name(self._things_by_name, self._things, thing, thing.name())
+        for cls in type(thing).__mro__:
+            self._things_by_type[cls].pop(thing.id(), None)
+        for code in thing._handlers().values():
+            self.discard_code(code)
+        self._discard_runners(thing)
+        self._removed(thing)
         self.save()
 
     def create_thing(self, cls):
         thing = create_thing(cls, self)
         thing._id = self._tseq
         self._tseq += 1
-        self._things[thing.id()] = thing
+        self._add_thing(thing)
         return thing
 
     def get_routes(self):
         return [] + sum([p.get_routes() for p in self._plugins.values()], [])
 
-    async def reconfigure(self):
-        for thing in self._things.values():
-            try:
-                await thing.reconfigure()
-            except:
-                pass
+    def reconfigure(self):
+        # Runs in the background -- poll reconfigure_job() for progress.
+        if self._reconfigure_job and self._reconfigure_job.running():
+            return self._reconfigure_job
+        self._reconfigure_job = ReconfigureJob(self, self._things.values())
+        self._reconfigure_job.start()
+        return self._reconfigure_job
+
+    def reconfigure_job(self):
+        return self._reconfigure_job
 
     def create_action(self):
         action = Action(self)
         action._id = self._aseq
         self._aseq += 1
-        self._actions[action.id()] = action
+        self._add_action(action)
         return action
 
-    async def http_get(self, url):
-        req = urllib.request.Request(url, headers=headers, data=data, method="GET")
-        try:
-            urllib.request.urlopen(req)
-        except:
-            pass
-
-    async def http_post(self, url, headers={}, data=None):
-        req = urllib.request.Request(url, headers=headers, data=data, method="POST")
-        try:
-            urllib.request.urlopen(req)
-        except:
-            pass
-
-    async def execute(self, code):
-        if not code.strip():
-            return True
-
-        LOG.debug("Executing code:\n%s", code)
-
-        code = (
-            """
-import asyncio
-async def __code():
-    import sys
-    import asyncio
-    import datetime
-    import time
-    import os
+    async def http_get(self, url, headers={}, wait=True, timeout=HTTP_TIMEOUT):
+        return await self._http.request("GET", url, wait=wait, timeout=timeout, headers=headers)
 
-    result = True
+    async def http_post(self, url, headers={}, data=None, wait=True, timeout=HTTP_TIMEOUT):
+        return await self._http.request("POST", url, wait=wait, timeout=timeout, headers=headers, data=data)
 
-    def cancel():
-        nonlocal result
-        result = False
-
-    try:
-"""
-            + "\n".join("        " + line for line in code.split("\n"))
-            + """
-    except Exception as e:
-        import sys
-        t, v, tb = sys.exc_info()
-        import logging
-        import traceback
-        logging.getLogger('hazard').error("Error in event handler: {}: {}\\n{}".format(t.__name__, v, ''.join(traceback.format_tb(tb))))
-
-    return result
-
-self._exec_task = asyncio.get_event_loop().create_task(__code())
-"""
-        )
+    def http_stats(self):
+        return self._http.stats()
 
+    def _make_globals(self):
         g = {
             "action": self.find_action,
             "thing": self.find_thing,
             "things": self.all_things,
+            "zone": self.zone,
             "state": self._state,
             "hour": lambda: datetime.datetime.now().hour,
             "minute": lambda: datetime.datetime.now().minute,
@@ -197,15 +610,139 @@ self._exec_task = asyncio.get_event_loop().create_task(__code())
             "http_post": self.http_post,
             "hazard": self,
         }
-        l = {
-            "self": self,
-        }
-
         g.update(LIGHT_LEVELS)
         g.update(LIGHT_TEMPS)
+        return g
 
-        exec(code, g, l)
+    def compile(self, code):
+        fn = self._code_cache.get(code, None)
+        if fn:
+            self._code_cache.move_to_end(code)
+            return fn
 
-        v = await self._exec_task
-        await Thing.flush_all(self)
-        return v
+        source = (
+            CODE_HEADER
+            + "\n".join("        " + line for line in code.split("\n"))
+            + CODE_FOOTER
+        )
+        try:
+            compiled = compile(source, "<handler>", "exec")
+        except SyntaxError as e:
+            # Report the line number relative to the handler, not the wrapper.
+            if e.lineno is not None:
+                e.lineno -= CODE_HEADER.count("\n")
+            raise
+
+        l = {}
+        exec(compiled, self._globals, l)
+        fn = l["__code"]
+
+        self._code_cache[code] = fn
+        while len(self._code_cache) > CODE_CACHE_SIZE:
+            self._code_cache.popitem(last=False)
+        return fn
+
+    def discard_code(self, code):
+        self._code_cache.pop(code, None)
+
+    def check_handlers(self, obj, previous=None):
+        handlers = obj._handlers()
+        for code in (previous or {}).values():
+            if code not in handlers.values():
+                self.discard_code(code)
+        errors = {}
+        for name, code in handlers.items():
+            if not code.strip():
+                continue
+            try:
+                self.compile(code)
+            except SyntaxError as e:
+                LOG.error('Syntax error in "%s/%s": %s (line %s)', obj.name(), name, e.msg, e.lineno)
+                errors[name] = "{} (line {})".format(e.msg, e.lineno)
+        return errors
+
+    def _discard_runners(self, owner):
+        for key in [k for k in self._runners if k[0] is owner]:
+            del self._runners[key]
+
+    def handler_stats(self):
+        return {
+            "running": self._handlers_running,
+            "limit": MAX_RUNNING_HANDLERS,
+            "handlers": [r.to_json() for r in self._runners.values()],
+        }
+
+    async def _run_code(self, fn, runner=None):
+        # Only top-level invocations count against the limit -- a nested one
+        # (e.g. action("x").invoke()) waiting for a slot held by its caller
+        # would deadlock.
+        if _IN_HANDLER.get():
+            return await self._run_code_unlimited(fn, runner)
+        async with self._handler_limit:
+            token = _IN_HANDLER.set(True)
+            try:
+                return await self._run_code_unlimited(fn, runner)
+            finally:
+                _IN_HANDLER.reset(token)
+
+    async def _run_code_unlimited(self, fn, runner):
+        self._handlers_running += 1
+        EXECUTES.inc()
+        try:
+            start = time.monotonic()
+            # Errors are reported through status rather than the return
+            # value, so that handlers can still "return" early.
+            status = {}
+            try:
+                v = await fn(status)
+            except asyncio.CancelledError:
+                # Restarted (see POLICY_RESTART). Still send whatever the
+                # code had queued so far.
+                self._create_task(Thing.flush_all(self))
+                raise
+            failed = status.get("failed", False)
+            code_time = time.monotonic() - start
+            start = time.monotonic()
+            # The flush sends everything queued by every handler (e.g. all of
+            # OsramLight.queue), so a restart must not cut it short.
+            await asyncio.shield(self._create_task(Thing.flush_all(self)))
+            flush_time = time.monotonic() - start
+            EXECUTE_DURATION.observe(code_time + flush_time)
+            if failed:
+                EXECUTE_ERRORS.inc()
+            if runner:
+                runner.record(code_time, flush_time, failed)
+            return v
+        finally:
+            self._handlers_running -= 1
+
+    async def execute(self, code, owner=None, handler=None, policy=POLICY_PARALLEL):
+        # owner/handler identify the handler (e.g. a thing and "active") so
+        # that its policy can be applied and its stats recorded.
+        if not code.strip():
+            return True
+
+        LOG.debug("Executing code:\n%s", code)
+
+        runner = None
+        if owner is not None:
+            key = (owner, handler)
+            if key not in self._runners:
+                self._runners[key] = HandlerRunner(owner, handler)
+            runner = self._runners[key]
+
+        start = time.monotonic()
+        try:
+            fn = self.compile(code)
+        except SyntaxError as e:
+            LOG.error("Syntax error in event handler: %s (line %s)", e.msg, e.lineno)
+            EXECUTE_ERRORS.inc()
+            if runner:
+                runner.record_error()
+            return False
+        if runner:
+            runner.record_compile(time.monotonic() - start)
+
+        if runner is None:
+            return await self._run_code(fn)
+        return await runner.run(policy, lambda: self._run_code(fn, runner))
@@ -0,0 +1,87 @@
+import aiohttp
+import asyncio
+import logging
+import time
+import urllib.parse
+
+LOG = logging.getLogger("hazard")
+
+# Maximum number of open connections to any one host.
+HTTP_LIMIT_PER_HOST = 4
+
+# Default total timeout (seconds) for a request.
+HTTP_TIMEOUT = 10
+
+
+class HttpClient:
+    def __init__(self):
+        self._session = None
+        self._stats = {}
+        self._tasks = set()
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit_per_host=HTTP_LIMIT_PER_HOST),
+                timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT),
+            )
+        return self._session
+
+    def _host_stats(self, url):
+        host = urllib.parse.urlsplit(url).netloc
+        if host not in self._stats:
+            self._stats[host] = {
+                "requests": 0,
+                "errors": 0,
+                "total_time": 0,
+                "max_time": 0,
+            }
+        return self._stats[host]
+
+    async def _request(self, method, url, timeout, **kwargs):
+        stats = self._host_stats(url)
+        stats["requests"] += 1
+        start = time.monotonic()
+        try:
+            async with self._get_session().request(
+                method, url, timeout=aiohttp.ClientTimeout(total=timeout), **kwargs
+            ) as response:
+                result = {
+                    "status": response.status,
+                    "text": await response.text(),
+                }
+            if response.status >= 400:
+                stats["errors"] += 1
+            return result
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            LOG.error("HTTP %s %s failed: %s", method, url, repr(e))
+            stats["errors"] += 1
+            return None
+        finally:
+            t = time.monotonic() - start
+            stats["total_time"] += t
+            stats["max_time"] = max(stats["max_time"], t)
+
+    async def request(self, method, url, wait=True, timeout=HTTP_TIMEOUT, **kwargs):
+        # Returns {"status": ..., "text": ...}, or None on failure. With
+        # wait=False the request runs in the background and None is returned
+        # immediately.
+        if wait:
+            return await self._request(method, url, timeout, **kwargs)
+        task = asyncio.create_task(self._request(method, url, timeout, **kwargs))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return None
+
+    def stats(self):
+        return {
+            host: dict(s, mean_time=s["total_time"] / s["requests"] if s["requests"] else 0)
+            for host, s in self._stats.items()
+        }
+
+    async def close(self):
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self._session:
+            await self._session.close()
+            self._session = None
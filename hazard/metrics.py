@@ -0,0 +1,180 @@
+import bisect
+
+# Latency bucket upper bounds, in seconds.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self._buckets = buckets
+        # One extra bucket for values above the last bound.
+        self._counts = [0] * (len(buckets) + 1)
+        self._count = 0
+        self._sum = 0
+        self._max = 0
+
+    def observe(self, value):
+        self._counts[bisect.bisect_left(self._buckets, value)] += 1
+        self._count += 1
+        self._sum += value
+        self._max = max(self._max, value)
+
+    def to_json(self):
+        cumulative = 0
+        buckets = {}
+        for le, n in zip(self._buckets + ("+Inf",), self._counts):
+            cumulative += n
+            buckets[str(le)] = cumulative
+        return {
+            "count": self._count,
+            "sum": self._sum,
+            "mean": self._sum / self._count if self._count else 0,
+            "max": self._max,
+            "buckets": buckets,
+        }
+
+
+class _Value:
+    def __init__(self):
+        self._value = 0
+        self._fn = None
+
+    def inc(self, n=1):
+        self._value += n
+
+    def dec(self, n=1):
+        self._value -= n
+
+    def set(self, value):
+        self._value = value
+
+    def set_function(self, fn):
+        # Sampled when the metrics are rendered, e.g. for queue lengths.
+        self._fn = fn
+
+    def value(self):
+        return self._fn() if self._fn else self._value
+
+
+class _Family:
+    def __init__(self, name, help, labels, child):
+        self._name = name
+        self._help = help
+        self._labels = tuple(labels)
+        self._child = child
+        self._children = {}
+        if not self._labels:
+            # Always report unlabelled metrics, even before the first update.
+            self.labels()
+
+    def labels(self, *values):
+        values = tuple(str(v) for v in values)
+        child = self._children.get(values, None)
+        if child is None:
+            child = self._children[values] = self._child()
+        return child
+
+    def _label_str(self, values, extra=()):
+        pairs = list(zip(self._labels, values)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join('{}="{}"'.format(k, _escape(v)) for k, v in pairs) + "}"
+
+    def render(self):
+        lines = [
+            "# HELP {} {}".format(self._name, self._help),
+            "# TYPE {} {}".format(self._name, self.TYPE),
+        ]
+        for values, child in self._children.items():
+            lines.extend(self._render_child(values, child))
+        return lines
+
+
+class Counter(_Family):
+    TYPE = "counter"
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels, _Value)
+
+    def inc(self, n=1):
+        self.labels().inc(n)
+
+    def _render_child(self, values, child):
+        return ["{}{} {}".format(self._name, self._label_str(values), child.value())]
+
+
+class Gauge(Counter):
+    TYPE = "gauge"
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def set_function(self, fn):
+        self.labels().set_function(fn)
+
+
+class HistogramFamily(_Family):
+    TYPE = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels, lambda: Histogram(buckets))
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def _render_child(self, values, child):
+        lines = []
+        cumulative = 0
+        for le, n in zip(child._buckets + ("+Inf",), child._counts):
+            cumulative += n
+            lines.append("{}_bucket{} {}".format(self._name, self._label_str(values, [("le", le)]), cumulative))
+        lines.append("{}_sum{} {}".format(self._name, self._label_str(values), child._sum))
+        lines.append("{}_count{} {}".format(self._name, self._label_str(values), child._count))
+        return lines
+
+
+def _escape(v):
+    return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+
+    def _register(self, metric):
+        # Registering the same name twice returns the existing metric, so
+        # modules can be reloaded and plugins can share metrics.
+        if metric._name in self._metrics:
+            return self._metrics[metric._name]
+        self._metrics[metric._name] = metric
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self._register(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=()):
+        return self._register(Gauge(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self._register(HistogramFamily(name, help, labels, buckets))
+
+    def render(self):
+        lines = []
+        for m in self._metrics.values():
+            lines.extend(m.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def counter(name, help, labels=()):
+    return REGISTRY.counter(name, help, labels)
+
+
+def gauge(name, help, labels=()):
+    return REGISTRY.gauge(name, help, labels)
+
+
+def histogram(name, help, labels=(), buckets=LATENCY_BUCKETS):
+    return REGISTRY.histogram(name, help, labels, buckets)
@@ -25,6 +25,9 @@ class HazardPlugin:
     def get_routes(self):
         return []
 
+    def _dependencies(self):
+        return []
+
     async def start(self):
         pass
 
@@ -1,32 +1,140 @@
 import aiohttp
+import gzip
+import hashlib
+import logging
+import os
+import time
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 from hazard.plugin import HazardPlugin, register_plugin
 
+LOG = logging.getLogger("hazard")
+
+# Relative to this file, not the working directory.
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# URL path -> (file, content type, compress).
+ASSETS = {
+    "/": ("app.html", "text/html", True),
+    "/app.js": ("dist/app.js", "application/javascript", True),
+    "/app.js.map": ("dist/app.js.map", "application/json", True),
+    # Already compressed.
+    "/ionicons.woff": ("ionicons.woff", "font/woff", False),
+}
+
+# Seconds between checking the files for changes.
+ASSET_CHECK_INTERVAL = 1
+
+# For requests that name the current content hash (e.g. app.js?v=...).
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+
+class _Asset:
+    def __init__(self, path, content_type, compress):
+        self.path = path
+        self.content_type = content_type
+        self.compress = compress
+        self.mtime = None
+        self.set_body(None)
+
+    def set_body(self, body):
+        self.body = body
+        self.hash = None
+        self.gzip = None
+        self.br = None
+        if body is None:
+            return
+        self.hash = hashlib.sha256(body).hexdigest()[:16]
+        if self.compress:
+            self.gzip = gzip.compress(body)
+            if brotli:
+                self.br = brotli.compress(body)
+
+    def etag(self, encoding=None):
+        # Each encoding is a different representation, so needs its own
+        # strong validator.
+        if encoding:
+            return '"{}-{}"'.format(self.hash, encoding)
+        return '"{}"'.format(self.hash)
+
 
 @register_plugin
 class AppPlugin(HazardPlugin):
     def __init__(self, hazard):
         super().__init__(hazard)
+        self._assets = {
+            route: _Asset(os.path.join(APP_DIR, path), content_type, compress)
+            for route, (path, content_type, compress) in ASSETS.items()
+        }
+        self._checked = 0
 
     def get_routes(self):
-        return [
-            aiohttp.web.get("/", self.handle_app),
-            aiohttp.web.get("/app.js", self.handle_app_js),
-            aiohttp.web.get("/app.js.map", self.handle_app_js_map),
-            aiohttp.web.get("/ionicons.woff", self.handle_app_icons),
-        ]
+        return [aiohttp.web.get(route, self.handle_asset) for route in ASSETS]
 
     async def start(self):
-        pass
+        self._refresh()
+
+    def _refresh(self):
+        # Reload any asset whose mtime has changed since it was loaded.
+        now = time.monotonic()
+        if now - self._checked < ASSET_CHECK_INTERVAL:
+            return
+        self._checked = now
+        changed = False
+        for asset in self._assets.values():
+            try:
+                mtime = os.stat(asset.path).st_mtime
+            except OSError:
+                if asset.body is not None or asset.mtime is None:
+                    LOG.warning('App asset "%s" not found', asset.path)
+                asset.mtime = 0
+                asset.set_body(None)
+                continue
+            if mtime == asset.mtime:
+                continue
+            with open(asset.path, "rb") as f:
+                asset.set_body(f.read())
+            asset.mtime = mtime
+            changed = True
+        if changed:
+            self._version_html()
 
-    async def handle_app(self, request):
-        return aiohttp.web.FileResponse("hazard/plugins/app/app.html")
+    def _version_html(self):
+        # Point app.html at the current bundle hash so the bundle itself can be
+        # cached forever, and a rebuild is picked up on the next page load.
+        html = self._assets["/"]
+        js = self._assets["/app.js"]
+        if html.body is None or js.body is None:
+            return
+        with open(html.path, "rb") as f:
+            body = f.read()
+        html.set_body(body.replace(b'src="app.js"', 'src="app.js?v={}"'.format(js.hash).encode()))
 
-    async def handle_app_js(self, request):
-        return aiohttp.web.FileResponse("hazard/plugins/app/dist/app.js")
+    async def handle_asset(self, request):
+        self._refresh()
+        asset = self._assets[request.path]
+        if asset.body is None:
+            raise aiohttp.web.HTTPNotFound()
 
-    async def handle_app_js_map(self, request):
-        return aiohttp.web.FileResponse("hazard/plugins/app/dist/app.js.map")
+        encoding, body = None, asset.body
+        accept = request.headers.get("Accept-Encoding", "")
+        if asset.br and "br" in accept:
+            encoding, body = "br", asset.br
+        elif asset.gzip and "gzip" in accept:
+            encoding, body = "gzip", asset.gzip
 
-    async def handle_app_icons(self, request):
-        return aiohttp.web.FileResponse("hazard/plugins/app/ionicons.woff")
+        headers = {
+            "ETag": asset.etag(encoding),
+            "Cache-Control": IMMUTABLE if request.query.get("v", None) == asset.hash else "no-cache",
+        }
+        if asset.compress:
+            headers["Vary"] = "Accept-Encoding"
+        if headers["ETag"] in request.headers.get("If-None-Match", "").split(", "):
+            return aiohttp.web.Response(status=304, headers=headers)
+        if encoding:
+            headers["Content-Encoding"] = encoding
+        return aiohttp.web.Response(body=body, content_type=asset.content_type, headers=headers)
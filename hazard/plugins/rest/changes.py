@@ -0,0 +1,67 @@
+import async_timeout
+import asyncio
+import collections
+
+from hazard.action import Action
+
+# Number of change records to keep for clients catching up with ?since=.
+CHANGE_RING_SIZE = 1024
+
+# Maximum seconds to hold a long-poll request waiting for a change.
+CHANGES_TIMEOUT = 30
+
+
+class ChangeFeed:
+    # Bounded ring of (version, obj, removed) records, so that a client can
+    # ask for everything that changed since the version it last saw. Clients
+    # that have fallen off the end of the ring are told to resync.
+    def __init__(self, hazard, size=CHANGE_RING_SIZE):
+        self._hazard = hazard
+        self._ring = collections.deque()
+        self._size = size
+        # Oldest version that changes() can still answer for.
+        self._floor = hazard._version
+        self._event = asyncio.Event()
+        hazard.add_listener(self._on_change)
+
+    def _on_change(self, obj, version, removed):
+        if len(self._ring) >= self._size:
+            self._floor = self._ring.popleft()[0]
+        self._ring.append((version, obj, removed))
+        self._event.set()
+        self._event = asyncio.Event()
+
+    def changes(self, since):
+        version = self._hazard.update_versions()
+        if since < self._floor or since > version:
+            return {"resync": True, "version": version}
+        latest = {}
+        for v, obj, removed in reversed(self._ring):
+            if v <= since:
+                break
+            latest.setdefault(obj, removed)
+        result = {
+            "version": version,
+            "things": [],
+            "actions": [],
+            "removed_things": [],
+            "removed_actions": [],
+        }
+        for obj, removed in reversed(latest.items()):
+            kind = "actions" if isinstance(obj, Action) else "things"
+            if removed:
+                result["removed_" + kind].append(obj.id())
+            else:
+                result[kind].append(self._hazard.serialized(obj)[2])
+        return result
+
+    async def wait(self, since, timeout=CHANGES_TIMEOUT):
+        # Returns as soon as there is anything newer than since, or after
+        # timeout with an empty set of changes.
+        if self._hazard.update_versions() == since:
+            try:
+                async with async_timeout.timeout(timeout):
+                    await self._event.wait()
+            except asyncio.TimeoutError:
+                pass
+        return self.changes(since)
@@ -0,0 +1,59 @@
+import asyncio
+import logging
+
+import hazard.metrics
+
+LOG = logging.getLogger("hazard")
+
+COALESCED = hazard.metrics.counter("hazard_rest_coalesced_total", "Thing actions replaced by a newer request before being sent.", ["action"])
+
+# Thing actions that set an absolute value, so only the most recent request
+# for a given thing matters.
+COALESCE_ACTIONS = ("level", "temperature", "hue", "saturation")
+
+
+class _Slot:
+    def __init__(self):
+        self.pending = None
+        self.task = None
+
+
+class CommandCoalescer:
+    # Latest-wins queue per key: while a command is in flight, a newer one
+    # replaces whatever is waiting rather than queueing behind it.
+    def __init__(self):
+        self._slots = {}
+
+    def should_coalesce(self, action, data):
+        # Relative changes (e.g. level delta or toggle) must all be applied.
+        return action in COALESCE_ACTIONS and data.get("delta", None) is None and not data.get("toggle", False)
+
+    async def run(self, key, coro_fn):
+        # Returns True once coro_fn has run, or False if it was superseded by
+        # a later request for the same key.
+        future = asyncio.get_running_loop().create_future()
+        slot = self._slots.get(key, None)
+        if slot is None:
+            slot = self._slots[key] = _Slot()
+            slot.task = asyncio.create_task(self._drain(key, slot))
+        elif slot.pending:
+            COALESCED.labels(key[-1]).inc()
+            slot.pending[1].set_result(False)
+        slot.pending = (coro_fn, future)
+        # Shielded so that a client disconnecting doesn't stop its (possibly
+        # latest) value from being sent.
+        return await asyncio.shield(future)
+
+    async def _drain(self, key, slot):
+        try:
+            while slot.pending:
+                coro_fn, future = slot.pending
+                slot.pending = None
+                try:
+                    await coro_fn()
+                    future.set_result(True)
+                except Exception as e:
+                    LOG.exception("Error running %s", key)
+                    future.set_exception(e)
+        finally:
+            del self._slots[key]
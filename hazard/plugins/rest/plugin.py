@@ -1,8 +1,18 @@
 import aiohttp
+import asyncio
+import gzip
+import json
+import logging
 
 from hazard.plugin import HazardPlugin, register_plugin
+import hazard.metrics
+from hazard.plugins.rest.changes import ChangeFeed, CHANGES_TIMEOUT
+from hazard.plugins.rest.coalesce import CommandCoalescer
+from hazard.plugins.rest.websocket import WebSocketClient
 from hazard.thing import Thing, get_thing_types
 
+LOG = logging.getLogger("hazard")
+
 
 @register_plugin
 class RestPlugin(HazardPlugin):
@@ -11,14 +21,30 @@ class RestPlugin(HazardPlugin):
         self._title_left = None
         self._title_center = None
         self._title_right = None
+        self._coalescer = CommandCoalescer()
+        self._ws_clients = set()
+        self._feed = ChangeFeed(hazard)
+        self._bootstrap = None
 
     async def start(self):
         pass
 
+    async def stop(self):
+        for client in list(self._ws_clients):
+            await client.close()
+
     def get_routes(self):
         return [
             aiohttp.web.get("/api/rest/status", self.handle_status),
+            aiohttp.web.get("/api/rest/bootstrap", self.handle_bootstrap),
             aiohttp.web.get("/api/rest/reconfigure", self.handle_reconfigure),
+            aiohttp.web.get("/api/rest/reconfigure/status", self.handle_reconfigure_status),
+            aiohttp.web.get("/api/rest/metrics", self.handle_metrics),
+            aiohttp.web.get("/api/rest/http/stats", self.handle_http_stats),
+            aiohttp.web.get("/api/rest/handler/stats", self.handle_handler_stats),
+            aiohttp.web.get("/api/rest/ws", self.handle_websocket),
+            aiohttp.web.get("/api/rest/changes", self.handle_changes),
+            aiohttp.web.get("/api/rest/changes/stream", self.handle_changes_stream),
             aiohttp.web.get("/api/rest/action/list", self.handle_action_list),
             aiohttp.web.post("/api/rest/action/create", self.handle_action_create),
             aiohttp.web.post("/api/rest/action/{id}", self.handle_action),
@@ -26,11 +52,15 @@ class RestPlugin(HazardPlugin):
             aiohttp.web.post("/api/rest/action/{id}/invoke", self.handle_action_invoke),
             aiohttp.web.get("/api/rest/thing/list", self.handle_thing_list),
             aiohttp.web.get("/api/rest/thing/types", self.handle_thing_type_list),
+            aiohttp.web.post("/api/rest/thing/batch", self.handle_thing_batch),
             aiohttp.web.post("/api/rest/thing/{id}", self.handle_thing),
             aiohttp.web.post("/api/rest/thing/{id}/remove", self.handle_thing_remove),
             aiohttp.web.post(
                 "/api/rest/thing/{id}/action/{action}", self.handle_thing_action
             ),
+            aiohttp.web.get("/api/rest/zone/list", self.handle_zone_list),
+            aiohttp.web.get("/api/rest/zone/{name}", self.handle_zone),
+            aiohttp.web.post("/api/rest/zone/{name}/action/{action}", self.handle_zone_action),
         ]
 
     def load_json(self, json):
@@ -38,6 +68,7 @@ class RestPlugin(HazardPlugin):
         self._title_left = json.get("title_left", None)
         self._title_center = json.get("title_center", None)
         self._title_right = json.get("title_right", None)
+        self._bootstrap = None
 
     def to_json(self):
         json = super().to_json()
@@ -58,30 +89,150 @@ class RestPlugin(HazardPlugin):
             raise aiohttp.web.HTTPNotFound("Unknown thing")
         return self._hazard._things[thing_id]
 
-    async def handle_status(self, request):
+    def _json_with_errors(self, obj, errors):
+        json = obj.to_json()
+        if errors:
+            json["errors"] = errors
+        return aiohttp.web.json_response(json)
+
+    def _status_json(self):
         # left = self._hazard.find_thing(self._title_left) if self._title_left else None
         # right = (
         #     self._hazard.find_thing(self._title_right) if self._title_right else None
         # )
-        status = {
+        return {
             "type": "Status",
             "json_type": "Status",
             "title_left": "",#left.to_json() if left else None,
             "title_center": self._title_center or "",
             "title_right": "",#right.to_json() if right else None,
         }
-        return aiohttp.web.json_response(status)
+
+    def _thing_types_json(self):
+        return [{"type": t} for t in get_thing_types()]
+
+    async def handle_status(self, request):
+        return aiohttp.web.json_response(self._status_json())
+
+    async def handle_bootstrap(self, request):
+        # Everything the app needs on startup in one round trip. The body (and
+        # its gzipped form) is rebuilt only when the global version moves.
+        version = self._hazard.update_versions()
+        etag = '"{}"'.format(version)
+        if self._bootstrap is None or self._bootstrap[0] != version:
+            body = b"".join(
+                (
+                    b'{"version": ',
+                    str(version).encode(),
+                    b', "status": ',
+                    json.dumps(self._status_json()).encode(),
+                    b', "things": [',
+                    b",".join(self._hazard.serialized(t)[1] for t in self._hazard._things.values()),
+                    b'], "actions": [',
+                    b",".join(self._hazard.serialized(a)[1] for a in self._hazard._actions.values()),
+                    b'], "types": ',
+                    json.dumps(self._thing_types_json()).encode(),
+                    b"}",
+                )
+            )
+            self._bootstrap = (version, body, gzip.compress(body))
+        body = self._bootstrap[1]
+        gzipped = "gzip" in request.headers.get("Accept-Encoding", "")
+        if gzipped:
+            # A different representation, so a different strong ETag.
+            etag = '"{}-gzip"'.format(version)
+            body = self._bootstrap[2]
+        not_modified = self._not_modified(request, etag)
+        if not_modified:
+            not_modified.headers["Vary"] = "Accept-Encoding"
+            return not_modified
+        headers = {"ETag": etag, "Vary": "Accept-Encoding"}
+        if gzipped:
+            headers["Content-Encoding"] = "gzip"
+        return aiohttp.web.Response(body=body, content_type="application/json", headers=headers)
 
     async def handle_reconfigure(self, request):
-        await self._hazard.reconfigure()
-        return aiohttp.web.json_response({})
+        job = self._hazard.reconfigure()
+        return aiohttp.web.json_response(job.to_json())
+
+    async def handle_reconfigure_status(self, request):
+        job = self._hazard.reconfigure_job()
+        if not job:
+            raise aiohttp.web.HTTPNotFound(text="No reconfigure job")
+        return aiohttp.web.json_response(job.to_json())
+
+    async def handle_metrics(self, request):
+        return aiohttp.web.Response(
+            text=hazard.metrics.REGISTRY.render(),
+            content_type="text/plain",
+            headers={"X-Content-Type-Options": "nosniff"},
+        )
+
+    async def handle_http_stats(self, request):
+        return aiohttp.web.json_response(self._hazard.http_stats())
+
+    async def handle_handler_stats(self, request):
+        return aiohttp.web.json_response(self._hazard.handler_stats())
+
+    async def handle_websocket(self, request):
+        ws = aiohttp.web.WebSocketResponse(heartbeat=30)
+        await ws.prepare(request)
+        client = WebSocketClient(self, ws)
+        self._ws_clients.add(client)
+        try:
+            await client.run()
+        finally:
+            self._ws_clients.discard(client)
+        return ws
+
+    def _since(self, request, default="0"):
+        try:
+            return int(request.query.get("since", default))
+        except ValueError:
+            raise aiohttp.web.HTTPBadRequest(text="Invalid version")
+
+    async def handle_changes(self, request):
+        since = self._since(request)
+        try:
+            timeout = min(float(request.query.get("timeout", CHANGES_TIMEOUT)), CHANGES_TIMEOUT)
+        except ValueError:
+            raise aiohttp.web.HTTPBadRequest(text="Invalid timeout")
+        return aiohttp.web.json_response(await self._feed.wait(since, timeout))
+
+    async def handle_changes_stream(self, request):
+        # Server-sent events. Browsers reconnect with Last-Event-ID, which is
+        # the version of the last event they received.
+        since = self._since(request, request.headers.get("Last-Event-ID", "0"))
+        response = aiohttp.web.StreamResponse(
+            headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"}
+        )
+        await response.prepare(request)
+        try:
+            while True:
+                changes = await self._feed.wait(since)
+                if changes.get("resync", False):
+                    event = "resync"
+                elif changes["version"] == since:
+                    await response.write(b": keep-alive\n\n")
+                    continue
+                else:
+                    event = "changes"
+                since = changes["version"]
+                await response.write(
+                    "event: {}\nid: {}\ndata: {}\n\n".format(event, since, json.dumps(changes)).encode()
+                )
+        except ConnectionError:
+            pass
+        return response
 
     async def handle_action(self, request):
         action = self._get_action_or_404(request)
         data = await request.json()
+        previous = action._handlers()
         action.load_json(data)
+        errors = self._hazard.check_handlers(action, previous)
         self._hazard.save()
-        return aiohttp.web.json_response(action.to_json())
+        return self._json_with_errors(action, errors)
 
     async def handle_action_list(self, request):
         return aiohttp.web.json_response(
@@ -92,8 +243,9 @@ class RestPlugin(HazardPlugin):
         data = await request.json()
         action = self._hazard.create_action()
         action.load_json(data)
+        errors = self._hazard.check_handlers(action)
         self._hazard.save()
-        return aiohttp.web.json_response(action.to_json())
+        return self._json_with_errors(action, errors)
 
     async def handle_action_remove(self, request):
         action = self._get_action_or_404(request)
@@ -110,30 +262,134 @@ class RestPlugin(HazardPlugin):
     async def handle_thing(self, request):
         thing = self._get_thing_or_404(request)
         data = await request.json()
+        previous = thing._handlers()
         thing.load_json(data)
+        errors = self._hazard.check_handlers(thing, previous)
         self._hazard.save()
-        return aiohttp.web.json_response(thing.to_json())
+        return self._json_with_errors(thing, errors)
+
+    def _not_modified(self, request, etag):
+        if etag in request.headers.get("If-None-Match", "").split(", "):
+            return aiohttp.web.Response(status=304, headers={"ETag": etag})
+        return None
+
+    def _json_list_response(self, objs, etag):
+        body = b"[" + b",".join(self._hazard.serialized(o)[1] for o in objs) + b"]"
+        return aiohttp.web.Response(
+            body=body, content_type="application/json", headers={"ETag": etag}
+        )
 
     async def handle_thing_list(self, request):
-        return aiohttp.web.json_response(
-            [t.to_json() for t in self._hazard._things.values()]
+        # Optional ?zone=, ?type=, ?json_type=, ?feature= filters, ?fields=
+        # projection and ?offset=/?limit= pagination (with the unpaginated
+        # count in X-Total-Count). Idle polling only costs a version check.
+        etag = '"{}"'.format(self._hazard.update_versions())
+        not_modified = self._not_modified(request, etag)
+        if not_modified:
+            return not_modified
+
+        query = request.query
+        things = self._hazard.query_things(
+            zone=query.get("zone", None),
+            type=query.get("type", None),
+            json_type=query.get("json_type", None),
+            feature=query.get("feature", None),
         )
+        total = len(things)
+        try:
+            offset = int(query.get("offset", 0))
+            limit = int(query["limit"]) if "limit" in query else None
+        except ValueError:
+            raise aiohttp.web.HTTPBadRequest(text="Invalid offset or limit")
+        if offset < 0 or (limit is not None and limit < 0):
+            raise aiohttp.web.HTTPBadRequest(text="Invalid offset or limit")
+        things = things[offset:offset + limit if limit is not None else None]
+
+        if "fields" not in query:
+            response = self._json_list_response(things, etag)
+        else:
+            fields = ["id"] + query["fields"].split(",")
+            projected = []
+            for t in things:
+                t_json = self._hazard.serialized(t)[2]
+                projected.append({f: t_json[f] for f in fields if f in t_json})
+            response = aiohttp.web.json_response(projected, headers={"ETag": etag})
+        response.headers["X-Total-Count"] = str(total)
+        return response
 
     async def handle_thing_type_list(self, request):
-        return aiohttp.web.json_response(
-            [
-                {
-                    "type": t,
-                }
-                for t in get_thing_types()
-            ]
-        )
+        return aiohttp.web.json_response(self._thing_types_json())
 
     async def handle_thing_action(self, request):
         thing = self._get_thing_or_404(request)
+        action = request.match_info["action"]
+        data = await request.json()
+
+        async def run():
+            await thing.action(action, data)
+            await Thing.flush_all(self._hazard)
+
+        if self._coalescer.should_coalesce(action, data):
+            # e.g. dragging a slider: only the latest value needs to be sent.
+            sent = await self._coalescer.run((thing.id(), action), run)
+            return aiohttp.web.json_response({"coalesced": not sent})
+        await run()
+        return aiohttp.web.json_response({})
+
+    async def _batch_item(self, item):
+        # Bad items are reported in their own result rather than failing the
+        # whole batch.
+        if not isinstance(item, dict):
+            return {"item": item, "error": "Expected an object"}
+        result = {"id": item.get("id", None), "action": item.get("action", None)}
+        args = item.get("args", {})
+        if not isinstance(args, dict):
+            result["error"] = "Expected an object for args"
+            return result
+        thing = self._hazard._things.get(result["id"], None) if isinstance(result["id"], (int, str)) else None
+        if thing is None:
+            result["error"] = "Unknown thing"
+            return result
+        try:
+            await thing.action(result["action"], args)
+            result["ok"] = True
+        except Exception as e:
+            LOG.exception('Error in batch action "%s" on "%s"', result["action"], thing.name())
+            result["error"] = "{}: {}".format(type(e).__name__, e)
+        return result
+
+    async def handle_thing_batch(self, request):
+        # [{"id": ..., "action": ..., "args": {...}}, ...]. All actions are
+        # applied before a single flush, so backends can group the commands.
+        data = await request.json()
+        if not isinstance(data, list):
+            raise aiohttp.web.HTTPBadRequest(text="Expected a list of actions")
+        results = await asyncio.gather(*(self._batch_item(item) for item in data))
+        await Thing.flush_all(self._hazard)
+        return aiohttp.web.json_response(results)
+
+    def _get_zone_or_404(self, request):
+        self._hazard.update_versions()
+        zone = self._hazard._zones.get(request.match_info["name"], None)
+        if zone is None or not zone.things():
+            raise aiohttp.web.HTTPNotFound(text="Unknown zone")
+        return zone
+
+    async def handle_zone_list(self, request):
+        return aiohttp.web.json_response(
+            [z.to_json() for z in self._hazard.all_zones() if z.things()]
+        )
+
+    async def handle_zone(self, request):
+        return aiohttp.web.json_response(self._get_zone_or_404(request).to_json())
+
+    async def handle_zone_action(self, request):
+        zone = self._get_zone_or_404(request)
         data = await request.json()
-        print(data)
-        await thing.action(request.match_info["action"], data)
+        try:
+            await zone.action(request.match_info["action"], data)
+        except ValueError as e:
+            raise aiohttp.web.HTTPBadRequest(text=str(e))
         await Thing.flush_all(self._hazard)
         return aiohttp.web.json_response({})
 
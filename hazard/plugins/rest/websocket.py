@@ -0,0 +1,172 @@
+import aiohttp
+import async_timeout
+import asyncio
+import json
+import logging
+
+import hazard.metrics
+from hazard.action import Action
+from hazard.thing import Thing
+
+LOG = logging.getLogger("hazard")
+
+WS_CLIENTS = hazard.metrics.gauge("hazard_ws_clients", "Connected WebSocket clients.")
+WS_SENT = hazard.metrics.counter("hazard_ws_messages_sent_total", "WebSocket messages sent to clients.")
+WS_SLOW = hazard.metrics.counter("hazard_ws_slow_clients_total", "WebSocket clients disconnected for not keeping up.")
+
+# Seconds to allow a single send before giving up on a client.
+WS_SEND_TIMEOUT = 10
+
+# Requests from one client that can be handled at once. Beyond this, reading
+# from the client stops until one finishes.
+WS_MAX_IN_FLIGHT = 8
+
+
+class WebSocketClient:
+    # One connected app. Changes are recorded as a set of dirty objects and
+    # sent as per-field diffs against what this client last saw, so a slow
+    # client just receives fewer, larger updates rather than a growing queue.
+    def __init__(self, plugin, ws):
+        self._plugin = plugin
+        self._hazard = plugin._hazard
+        self._ws = ws
+        self._dirty = {}
+        self._wake = asyncio.Event()
+        self._sent = {}
+        self._tasks = set()
+        self._in_flight = asyncio.Semaphore(WS_MAX_IN_FLIGHT)
+
+    def _on_change(self, obj, version, removed):
+        self._dirty[obj] = removed
+        self._wake.set()
+
+    async def _send(self, msg):
+        async with async_timeout.timeout(WS_SEND_TIMEOUT):
+            await self._ws.send_str(json.dumps(msg))
+        WS_SENT.inc()
+
+    def _kind(self, obj):
+        return "action" if isinstance(obj, Action) else "thing"
+
+    async def _send_snapshot(self):
+        version = self._hazard.update_versions()
+        snapshot = {"type": "snapshot", "version": version, "things": [], "actions": []}
+        for key, objs in (("things", self._hazard._things), ("actions", self._hazard._actions)):
+            for obj in objs.values():
+                obj_json = self._hazard.serialized(obj)[2]
+                self._sent[obj] = obj_json
+                snapshot[key].append(obj_json)
+        await self._send(snapshot)
+
+    async def _send_changes(self):
+        await self._send_snapshot()
+        while True:
+            await self._wake.wait()
+            self._wake.clear()
+            dirty, self._dirty = self._dirty, {}
+            for obj, removed in dirty.items():
+                kind = self._kind(obj)
+                if removed:
+                    if self._sent.pop(obj, None) is not None:
+                        await self._send({"type": kind + "_removed", "id": obj.id(), "version": self._hazard._version})
+                    continue
+                version, _, obj_json = self._hazard.serialized(obj)
+                previous = self._sent.get(obj, None)
+                if previous is None:
+                    msg = {"type": kind, "id": obj.id(), "version": version, "json": obj_json}
+                else:
+                    changes = {k: v for k, v in obj_json.items() if k not in previous or previous[k] != v}
+                    # Some fields are only included when set (e.g. a light's
+                    # hue), so clients need to be told when they go away.
+                    removed_fields = [k for k in previous if k not in obj_json]
+                    if not changes and not removed_fields:
+                        continue
+                    msg = {"type": kind, "id": obj.id(), "version": version, "changes": changes}
+                    if removed_fields:
+                        msg["removed_fields"] = removed_fields
+                self._sent[obj] = obj_json
+                await self._send(msg)
+
+    async def _thing_action(self, msg):
+        thing = self._hazard._things.get(msg.get("id", None), None)
+        if thing is None:
+            raise ValueError("Unknown thing")
+        action = msg.get("action", None)
+        data = msg.get("args", {})
+
+        async def run():
+            await thing.action(action, data)
+            await Thing.flush_all(self._hazard)
+
+        coalescer = self._plugin._coalescer
+        if coalescer.should_coalesce(action, data):
+            return {"coalesced": not await coalescer.run((thing.id(), action), run)}
+        await run()
+        return {}
+
+    async def _action_invoke(self, msg):
+        action = self._hazard._actions.get(msg.get("id", None), None)
+        if action is None:
+            raise ValueError("Unknown action")
+        await action.invoke(msg.get("args", None))
+        return {}
+
+    async def _handle(self, msg):
+        handlers = {
+            "thing_action": self._thing_action,
+            "action_invoke": self._action_invoke,
+        }
+        result = {"type": "result", "seq": msg.get("seq", None)}
+        try:
+            if msg.get("type", None) not in handlers:
+                raise ValueError("Unknown message type")
+            result.update(await handlers[msg["type"]](msg))
+            result["ok"] = True
+        except Exception as e:
+            LOG.exception("Error handling WebSocket message")
+            result["error"] = "{}: {}".format(type(e).__name__, e)
+        try:
+            await self._send(result)
+        except (asyncio.TimeoutError, ConnectionError):
+            # The sender notices this too and closes the connection.
+            pass
+
+    def _sender_done(self, task):
+        if not task.cancelled() and isinstance(task.exception(), asyncio.TimeoutError):
+            LOG.warning("Disconnecting slow WebSocket client")
+            WS_SLOW.inc()
+        asyncio.ensure_future(self._ws.close())
+
+    def _request_done(self, task):
+        self._tasks.discard(task)
+        self._in_flight.release()
+
+    async def run(self):
+        self._hazard.add_listener(self._on_change)
+        WS_CLIENTS.labels().inc()
+        sender = asyncio.create_task(self._send_changes())
+        sender.add_done_callback(self._sender_done)
+        try:
+            async for message in self._ws:
+                if message.type != aiohttp.WSMsgType.TEXT:
+                    continue
+                try:
+                    msg = json.loads(message.data)
+                except ValueError:
+                    LOG.warning("Invalid WebSocket message")
+                    continue
+                # Handled in the background so a slow action doesn't hold up
+                # reading (and replying to) the next message.
+                await self._in_flight.acquire()
+                task = asyncio.create_task(self._handle(msg))
+                self._tasks.add(task)
+                task.add_done_callback(self._request_done)
+        finally:
+            self._hazard.remove_listener(self._on_change)
+            WS_CLIENTS.labels().dec()
+            sender.cancel()
+            for task in list(self._tasks):
+                task.cancel()
+
+    async def close(self):
+        await self._ws.close()
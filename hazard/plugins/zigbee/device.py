@@ -1,13 +1,20 @@
 import asyncio
 import async_timeout
 import logging
+import time
 
 from hazard.plugins.zigbee.common import ZigBeeDeliveryFailure, ZigBeeTimeout
+import hazard.metrics
 
 import zcl.spec
 
 LOG = logging.getLogger("hazard")
 
+ZCL_REQUESTS = hazard.metrics.counter("hazard_zigbee_requests_total", "ZDO/ZCL requests sent to devices.")
+ZCL_TIMEOUTS = hazard.metrics.counter("hazard_zigbee_timeouts_total", "ZDO/ZCL requests that got no response.")
+ZCL_DELIVERY_FAILURES = hazard.metrics.counter("hazard_zigbee_delivery_failures_total", "ZDO/ZCL requests that could not be delivered.")
+ZCL_LATENCY = hazard.metrics.histogram("hazard_zigbee_request_seconds", "ZDO/ZCL request round trip time.")
+
 
 class ZigBeeDevice:
     def __init__(self, network, addr64=0, addr16=0, name=""):
@@ -188,6 +195,9 @@ class ZigBeeDevice:
         f = asyncio.Future()
         self._inflight[seq] = f
 
+        ZCL_REQUESTS.inc()
+        start = time.monotonic()
+
         # print(hex(seq))
         result = await self._network._module.unicast(
             self._addr64,
@@ -201,12 +211,16 @@ class ZigBeeDevice:
         if not result:
             f.cancel()
             del self._inflight[seq]
+            ZCL_DELIVERY_FAILURES.inc()
             raise ZigBeeDeliveryFailure()
 
         try:
             async with async_timeout.timeout(timeout):
-                return await f
+                result = await f
+            ZCL_LATENCY.observe(time.monotonic() - start)
+            return result
         except asyncio.TimeoutError:
+            ZCL_TIMEOUTS.inc()
             raise ZigBeeTimeout() from None
         finally:
             del self._inflight[seq]
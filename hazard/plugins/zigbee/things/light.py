@@ -53,14 +53,17 @@ class ZigBeeLight(Light):
         ):
             if cluster_name == "onoff":
                 self._on = bool(kwargs["attributes"][0]["value"])
+                self._report(onoff=self._on)
                 LOG.info('Update "%s" onoff=%s', self._name, self._on)
             elif cluster_name == "level_control":
                 self._level = (kwargs["attributes"][0]["value"] - 1) / 253
+                self._report(level=kwargs["attributes"][0]["value"])
                 LOG.info('Update "%s" level=%f', self._name, self._level)
             elif cluster_name == "color":
                 if kwargs["attributes"][0]["attribute"] == 7:
                     mireds = kwargs["attributes"][0]["value"]
                     self._temperature = int(1e6 / mireds)
+                    self._report(mireds=mireds)
                     LOG.info(
                         'Update "%s" temperature=%f', self._name, self._temperature
                     )
@@ -90,11 +93,15 @@ class ZigBeeLight(Light):
             if t:
                 t.update()
 
-    async def on(self, soft=False):
+    async def on(self, soft=False, force=False):
         if not self._device:
             return
         prev = self._on
         await super().on()
+        if not force and self._is_reported(onoff=True):
+            self._suppress()
+            return
+        self._desire(onoff=True)
         LOG.info('Sending ON command to "%s"', self._name)
         try:
             if soft:
@@ -124,11 +131,15 @@ class ZigBeeLight(Light):
             self._on = prev
         self.update_groups()
 
-    async def off(self, soft=False):
+    async def off(self, soft=False, force=False):
         if not self._device:
             return
         prev = self._on
         await super().off()
+        if not force and self._is_reported(onoff=False):
+            self._suppress()
+            return
+        self._desire(onoff=False)
         LOG.info('Sending OFF command to "%s"', self._name)
         try:
             if soft and self._level > LOW_LEVEL:
@@ -162,6 +173,7 @@ class ZigBeeLight(Light):
         if not self._device:
             return
         await super().toggle()
+        self._forget("onoff")
         await self._device.zcl_cluster(
             zcl.spec.Profile.HOME_AUTOMATION,
             self._endpoint,
@@ -170,15 +182,23 @@ class ZigBeeLight(Light):
             timeout=5,
         )
 
-    async def level(self, level=None, delta=None, onoff=False, soft=False):
+    async def level(self, level=None, delta=None, onoff=False, soft=False, force=False):
         if not self._device:
             return
         prev_on = self._on
         prev_level = self._level
         await super().level(level, delta)
+        expected = {"level": int(self._level * 255)}
         command = "move_to_level"
         if onoff:
+            # e.g. undim of a light that was switched off with a plain "off",
+            # so still reports the same level.
+            expected["onoff"] = True
             command += "_on_off"
+        if not force and self._is_reported(**expected):
+            self._suppress()
+            return
+        self._desire(**expected)
         time = TRANSITION_TIME_SOFT if soft else TRANSITION_TIME_HARD
         LOG.info('Sending LEVEL command to "%s"', self._name)
         try:
@@ -205,6 +225,8 @@ class ZigBeeLight(Light):
         if not self._device:
             return
         await super().hue(hue, delta)
+        # No longer in colour temperature mode.
+        self._forget("mireds")
         await self._device.zcl_cluster(
             zcl.spec.Profile.HOME_AUTOMATION,
             self._endpoint,
@@ -221,6 +243,7 @@ class ZigBeeLight(Light):
         if not self._device:
             return
         await super().saturation(saturation)
+        self._forget("mireds")
         await self._device.zcl_cluster(
             zcl.spec.Profile.HOME_AUTOMATION,
             self._endpoint,
@@ -234,11 +257,15 @@ class ZigBeeLight(Light):
         )
         self.update_groups()
 
-    async def temperature(self, temperature):
+    async def temperature(self, temperature, force=False):
         if not self._device:
             return
         await super().temperature(temperature)
         mireds = int(1e6 / temperature)
+        if not force and self._is_reported(mireds=mireds):
+            self._suppress()
+            return
+        self._desire(mireds=mireds)
         await self._device.zcl_cluster(
             zcl.spec.Profile.HOME_AUTOMATION,
             self._endpoint,
@@ -326,9 +353,9 @@ class ZigBeeLight(Light):
             ids=group_ids,
         )
         # ('get_group_membership_response', {'capacity': 3, 'ids': [3, 4, 8, 16, 18]})
-        self._groups = []
-        for addr16 in memberships[1].get("ids", []):
-            self._groups.append(addr16)
+        # Assigned as a whole (rather than appended to) so that the change
+        # is seen by Thing.__setattr__.
+        self._groups = list(memberships[1].get("ids", []))
 
     async def reconfigure(self):
         await super().reconfigure()
@@ -399,12 +426,17 @@ class ZigBeeLightGroup(Light):
         t = self._member_temperatures()
         return int(max(t)) if t else None
 
-    async def on(self, soft=False):
+    async def on(self, soft=False, force=False):
         if not self._group:
             return
         await super().on()
         for light in self._group.find_member_things(ZigBeeLight):
             await super(ZigBeeLight, light).on()
+            # The members' own commands check against this (see
+            # ZigBeeLight.on), so it has to be kept up to date here too.
+            light._desire(onoff=True)
+            if soft:
+                light._forget("level")
         for light_group in self._group.find_subgroup_things(
             ZigBeeLightGroup, ZigBeeLight
         ):
@@ -431,7 +463,7 @@ class ZigBeeLightGroup(Light):
             )
         LOG.debug(' --> done ("%s")', self._name)
 
-    async def off(self, soft=False):
+    async def off(self, soft=False, force=False):
         if not self._group:
             return
 
@@ -441,6 +473,9 @@ class ZigBeeLightGroup(Light):
         await super().off()
         for light in self._group.find_member_things(ZigBeeLight):
             await super(ZigBeeLight, light).off()
+            light._desire(onoff=False)
+            if soft:
+                light._forget("level")
         for light_group in self._group.find_subgroup_things(
             ZigBeeLightGroup, ZigBeeLight
         ):
@@ -471,6 +506,8 @@ class ZigBeeLightGroup(Light):
         if not self._group:
             return
         await super().toggle()
+        for light in self._group.find_member_things(ZigBeeLight):
+            light._forget("onoff")
         await self._group.zcl_cluster(
             zcl.spec.Profile.HOME_AUTOMATION,
             self._endpoint,
@@ -479,12 +516,15 @@ class ZigBeeLightGroup(Light):
             timeout=5,
         )
 
-    async def level(self, level=None, delta=None, onoff=False, soft=False):
+    async def level(self, level=None, delta=None, onoff=False, soft=False, force=False):
         if not self._group:
             return
         await super().level(level, delta)
         for light in self._group.find_member_things(ZigBeeLight):
             await super(ZigBeeLight, light).level(level, delta)
+            light._desire(level=int(self._level * 255))
+            if onoff:
+                light._desire(onoff=True)
         for light_group in self._group.find_subgroup_things(
             ZigBeeLightGroup, ZigBeeLight
         ):
@@ -510,6 +550,7 @@ class ZigBeeLightGroup(Light):
         await super().hue(hue)
         for light in self._group.find_member_things(ZigBeeLight):
             await super(ZigBeeLight, light).hue(hue)
+            light._forget("mireds")
         for light_group in self._group.find_subgroup_things(
             ZigBeeLightGroup, ZigBeeLight
         ):
@@ -532,6 +573,7 @@ class ZigBeeLightGroup(Light):
         await super().saturation(saturation)
         for light in self._group.find_member_things(ZigBeeLight):
             await super(ZigBeeLight, light).saturation(saturation)
+            light._forget("mireds")
         for light_group in self._group.find_subgroup_things(
             ZigBeeLightGroup, ZigBeeLight
         ):
@@ -549,12 +591,13 @@ class ZigBeeLightGroup(Light):
             time=TRANSITION_TIME_SOFT,
         )
 
-    async def temperature(self, temperature):
+    async def temperature(self, temperature, force=False):
         if not self._group:
             return
         await super().temperature(temperature)
         for light in self._group.find_member_things(ZigBeeLight):
             await super(ZigBeeLight, light).temperature(temperature)
+            light._desire(mireds=int(1e6 / temperature))
         for light_group in self._group.find_subgroup_things(
             ZigBeeLightGroup, ZigBeeLight
         ):
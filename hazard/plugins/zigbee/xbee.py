@@ -6,9 +6,15 @@ import logging
 
 from hazard.plugins.zigbee.common import ZigBeeTimeout
 from hazard.plugins.zigbee.module import ZigBeeModule
+import hazard.metrics
 
 LOG = logging.getLogger("hazard")
 
+FRAMES_RX = hazard.metrics.counter("hazard_xbee_frames_rx_total", "XBee API frames received.")
+FRAMES_TX = hazard.metrics.counter("hazard_xbee_frames_tx_total", "XBee API frames sent.")
+CHECKSUM_ERRORS = hazard.metrics.counter("hazard_xbee_checksum_errors_total", "XBee frames dropped due to a bad checksum.")
+INFLIGHT = hazard.metrics.gauge("hazard_xbee_inflight_frames", "XBee frames awaiting a response.")
+
 
 class XBeeProtocol(asyncio.Protocol):
     def __init__(self, xbee_module):
@@ -94,6 +100,7 @@ class XBeeProtocol(asyncio.Protocol):
                 if chk_expected == chk_actual:
                     self._xbee_module._on_frame(frame)
                 else:
+                    CHECKSUM_ERRORS.inc()
                     LOG.error(
                         "bad escape frame checksum at %d: %s from %s",
                         i,
@@ -113,6 +120,7 @@ class XBeeProtocol(asyncio.Protocol):
                 if chk == self._data[i + frame_len - 1]:
                     self._xbee_module._on_frame(data)
                 else:
+                    CHECKSUM_ERRORS.inc()
                     LOG.error("bad unescaped frame checksum at %d: %s", i, repr(data))
                 self._data = self._data[i + frame_len :]
                 return True
@@ -151,6 +159,7 @@ class XBeeModule(ZigBeeModule):
         self._port = ""
         self._baudrate = 0
         self._rx = False
+        INFLIGHT.set_function(lambda: len(self._inflight))
 
     def load_json(self, json):
         super().load_json(json)
@@ -288,6 +297,7 @@ class XBeeModule(ZigBeeModule):
         data = data[1:]
 
         self._rx = True
+        FRAMES_RX.inc()
 
         if frame_type in (
             0x88,
@@ -370,6 +380,7 @@ class XBeeModule(ZigBeeModule):
                 + struct.pack("B", self._protocol._checksum(data))
             )
         # print('sending', data)
+        FRAMES_TX.inc()
 
         if status:
             f = asyncio.Future()
@@ -3,10 +3,16 @@ import json
 from hazard.plugin import HazardPlugin, register_plugin
 
 import hazard.plugins.zigbee2mqtt.things
+from hazard.plugins.zigbee2mqtt.router import Message, TopicRouter
+import hazard.metrics
 
 import aiomqtt
 import asyncio
 
+MQTT_RECEIVED = hazard.metrics.counter("hazard_mqtt_messages_received_total", "MQTT messages received, by topic prefix.", ["prefix"])
+MQTT_UNROUTED = hazard.metrics.counter("hazard_mqtt_messages_unrouted_total", "MQTT messages received with no subscriber.")
+MQTT_PUBLISHED = hazard.metrics.counter("hazard_mqtt_messages_published_total", "MQTT messages published.")
+
 
 @register_plugin
 class ZigBee2MqttPlugin(HazardPlugin):
@@ -14,11 +20,14 @@ class ZigBee2MqttPlugin(HazardPlugin):
         super().__init__(hazard)
         self._devices_task = None
         self._groups_task = None
+        self._dispatch_task = None
+        self._router = TopicRouter()
         self._broker = "localhost"
         self._client = None
         self._devices_by_addr = {}
         self._groups = []
         self._group_members = {}
+        self._groups_by_members = {}
 
     def load_json(self, json):
         super().load_json(json)
@@ -30,37 +39,82 @@ class ZigBee2MqttPlugin(HazardPlugin):
         return json
 
     async def publish(self, topic, message):
+        MQTT_PUBLISHED.inc()
         await self._client.publish(topic, json.dumps(message))
 
     def update_group_membership(self):
         if not self._devices_by_addr or not self._groups:
             return
         self._group_members = {}
+        self._groups_by_members = {}
         for g in self._groups:
             n = g["friendly_name"]
-            self._group_members[n] = set()
+            members = set()
             for m in g["members"]:
                 addr = m["ieee_address"]
                 if addr in self._devices_by_addr:
-                    self._group_members[n].add(self._devices_by_addr[addr])
+                    members.add(self._devices_by_addr[addr])
+            self._group_members[n] = frozenset(members)
+            if members:
+                self._groups_by_members.setdefault(frozenset(members), n)
 
     def find_group_by_members(self, members):
-        for n, m in self._group_members.items():
-            if m == members:
-                return n
-        return None
+        return self._groups_by_members.get(frozenset(members), None)
+
+    def plan_publish(self, members, optional=()):
+        # Cover the target devices with as few publishes as possible, using
+        # groups that contain only targets (so nothing else changes state) and
+        # individual publishes for the rest. Optional devices (e.g. ones
+        # already in the target state) may be included in a group but don't
+        # need to be covered. Returns (groups, individuals).
+        members = frozenset(members)
+        allowed = members | frozenset(optional)
+        for m in (members, allowed):
+            group = self.find_group_by_members(m)
+            if group:
+                return [group], set()
+
+        candidates = {m: n for m, n in self._groups_by_members.items() if len(m) > 1 and m <= allowed}
+        remaining = set(members)
+        groups = []
+        while candidates and len(remaining) > 1:
+            # Greedy set cover: most newly-covered devices, then least overlap.
+            m, n = max(candidates.items(), key=lambda mn: (len(mn[0] & remaining), -len(mn[0])))
+            # A group only saves anything if it replaces at least two publishes.
+            if len(m & remaining) < 2:
+                break
+            groups.append(n)
+            remaining -= m
+            del candidates[m]
+        return groups, remaining
+
+    def subscribe(self, topic):
+        return self._router.subscribe(topic)
 
     async def topic_messages(self, topic: str):
+        sub = self.subscribe(topic)
+        try:
+            async for message in sub:
+                yield message
+        finally:
+            sub.close()
+
+    async def dispatch_task(self):
+        # The only broker subscription -- everything else is routed locally.
         async with self._client.messages() as messages:
-            await self._client.subscribe(topic + "/#")
+            await self._client.subscribe("zigbee2mqtt/#")
             async for message in messages:
-                if message.topic.matches(topic):
-                    yield message
+                message = Message(message.topic.value, message.payload, message.retain)
+                # Labelled by prefix rather than topic, so there isn't a
+                # series per device.
+                MQTT_RECEIVED.labels("bridge" if message.topic.startswith("zigbee2mqtt/bridge/") else "device").inc()
+                if not self._router.dispatch(message):
+                    MQTT_UNROUTED.inc()
 
     async def devices_task(self):
         print(f"start devices task")
         async for message in self.topic_messages(f"zigbee2mqtt/bridge/devices"):
-            devices = json.loads(message.payload)
+            devices = message.json
             self._devices_by_addr = {d["ieee_address"]: d["friendly_name"] for d in devices}
             self.update_group_membership()
             print("updated devices")
@@ -68,7 +122,7 @@ class ZigBee2MqttPlugin(HazardPlugin):
     async def groups_task(self):
         print(f"start groups task")
         async for message in self.topic_messages(f"zigbee2mqtt/bridge/groups"):
-            self._groups = json.loads(message.payload)
+            self._groups = message.json
             self.update_group_membership()
             print("updated groups")
 
@@ -76,13 +130,15 @@ class ZigBee2MqttPlugin(HazardPlugin):
         print("Connecting to mqtt broker")
         self._client = aiomqtt.Client(self._broker)
         await self._client.connect()
+        self._dispatch_task = asyncio.create_task(self.dispatch_task())
         self._devices_task = asyncio.create_task(self.devices_task())
         self._groups_task = asyncio.create_task(self.groups_task())
 
     async def stop(self):
+        self._dispatch_task.cancel()
         self._devices_task.cancel()
         self._groups_task.cancel()
-        await asyncio.gather(self._devices_task, self._groups_task)
+        await asyncio.gather(self._dispatch_task, self._devices_task, self._groups_task, return_exceptions=True)
 
     def client(self):
         return self._client
@@ -0,0 +1,129 @@
+import asyncio
+import json
+import logging
+import time
+
+import hazard.metrics
+
+LOG = logging.getLogger("hazard")
+
+MQTT_DISPATCH = hazard.metrics.histogram("hazard_mqtt_dispatch_seconds", "Time from MQTT message receipt to its handler picking it up.", ["topic"])
+
+
+class Message:
+    def __init__(self, topic, payload, retain=False):
+        self.topic = topic
+        self.payload = payload
+        self.retain = retain
+        self.received = time.monotonic()
+        # Parsed once here rather than by every subscriber.
+        try:
+            self.json = json.loads(payload)
+        except ValueError:
+            self.json = None
+
+
+class Subscription:
+    def __init__(self, router, topic):
+        self._router = router
+        self._topic = topic
+        self._queue = asyncio.Queue()
+
+    def topic(self):
+        return self._topic
+
+    def deliver(self, message):
+        self._queue.put_nowait(message)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        message = await self._queue.get()
+        MQTT_DISPATCH.labels(self._topic).observe(time.monotonic() - message.received)
+        return message
+
+    def close(self):
+        self._router.unsubscribe(self)
+
+
+class _Node:
+    def __init__(self):
+        self.children = {}
+        self.subscriptions = []
+
+
+class TopicRouter:
+    # Routes messages to subscriptions using a trie of topic filter levels,
+    # supporting the MQTT "+" and "#" wildcards.
+    def __init__(self):
+        self._root = _Node()
+        self._retained = {}
+
+    def subscribe(self, topic):
+        sub = Subscription(self, topic)
+        node = self._root
+        for level in topic.split("/"):
+            node = node.children.setdefault(level, _Node())
+        node.subscriptions.append(sub)
+
+        # New subscribers still need to see retained messages (e.g. the bridge
+        # device list) that arrived before they subscribed.
+        if "+" in topic or "#" in topic:
+            for message in self._retained.values():
+                if sub in self._match(message.topic):
+                    sub.deliver(message)
+        elif topic in self._retained:
+            sub.deliver(self._retained[topic])
+        return sub
+
+    def unsubscribe(self, sub):
+        node = self._root
+        path = []
+        for level in sub.topic().split("/"):
+            path.append((node, level))
+            node = node.children.get(level, None)
+            if node is None:
+                return
+        if sub in node.subscriptions:
+            node.subscriptions.remove(sub)
+        # Prune empty branches.
+        for parent, level in reversed(path):
+            child = parent.children[level]
+            if child.subscriptions or child.children:
+                break
+            del parent.children[level]
+
+    def _match(self, topic):
+        result = []
+        nodes = [self._root]
+        levels = topic.split("/")
+        for level in levels:
+            next_nodes = []
+            for node in nodes:
+                if "#" in node.children:
+                    result.extend(node.children["#"].subscriptions)
+                if level in node.children:
+                    next_nodes.append(node.children[level])
+                if "+" in node.children:
+                    next_nodes.append(node.children["+"])
+            nodes = next_nodes
+            if not nodes:
+                return result
+        for node in nodes:
+            result.extend(node.subscriptions)
+            # "a/#" also matches "a".
+            if "#" in node.children:
+                result.extend(node.children["#"].subscriptions)
+        return result
+
+    def dispatch(self, message):
+        if message.retain:
+            if message.payload:
+                self._retained[message.topic] = message
+            else:
+                self._retained.pop(message.topic, None)
+        subs = self._match(message.topic)
+        for sub in subs:
+            sub.deliver(message)
+        return subs
@@ -37,7 +37,7 @@ class HueSwitch(Switch):
         plugin = self._hazard.find_plugin("ZigBee2MqttPlugin")
         async for message in plugin.topic_messages(f"zigbee2mqtt/{self._name}"):
             print(self._name, message.payload.decode())
-            message = json.loads(message.payload)
+            message = message.json or {}
             if "action" in message:
                 await self.dispatch_action(message)
             if "battery" in message:
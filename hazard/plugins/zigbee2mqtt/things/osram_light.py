@@ -1,42 +1,108 @@
 import asyncio
+import json
 import logging
+import time
 
 from hazard.thing import register_thing
 from hazard.things import Light, LEVEL_OFF, LEVEL_MIN, LEVEL_ALL, LEVEL_MAX, TEMP_COOL, TEMP_WARM
+import hazard.metrics
 
 LOG = logging.getLogger("hazard")
 
+# State keys reported by zigbee2mqtt that we also command.
+REPORTED_KEYS = ("state", "brightness", "color_temp")
+
+# Seconds to wait for a light to report the commanded state before retrying.
+RECONCILE_DEADLINE = 3
+RECONCILE_RETRIES = 2
+
+CONFIRM_LATENCY = hazard.metrics.histogram("hazard_z2m_light_confirm_seconds", "Time from publishing a light command to the light reporting that state.", ["thing"])
+RETRIES = hazard.metrics.counter("hazard_z2m_light_retries_total", "Light commands resent because the light didn't report the new state.", ["thing"])
+UNCONFIRMED = hazard.metrics.counter("hazard_z2m_light_unconfirmed_total", "Light commands never confirmed after all retries.", ["thing"])
+
 
 @register_thing
 class OsramLight(Light):
     queue = []
+    reconcile_tasks = set()
 
     def __init__(self, hazard):
         super().__init__(hazard)
         self._temperature = TEMP_WARM
+        self._task = None
+        # (expected reported state, time sent) for the last unconfirmed command.
+        self._pending = None
+        self._attempt = 0
+
+    async def task(self):
+        plugin = self._hazard.find_plugin("ZigBee2MqttPlugin")
+        async for message in plugin.topic_messages(f"zigbee2mqtt/{self._name}"):
+            message = message.json or {}
+            self._report(**{k: message[k] for k in REPORTED_KEYS if k in message})
+            if self._pending and self._confirmed(self._pending[0]):
+                CONFIRM_LATENCY.labels(self._name).observe(time.monotonic() - self._pending[1])
+                self._pending = None
+                # Confirmed within tolerance, which _report may not have
+                # matched exactly.
+                self._desired.clear()
+
+    def _confirmed(self, expected):
+        expected = dict(expected)
+        if expected.get("brightness", None) == 0:
+            # Brightness 0 turns the light off, but the last brightness is
+            # still reported.
+            del expected["brightness"]
+            expected["state"] = "OFF"
+        for k, v in expected.items():
+            r = self._reported.get(k, None)
+            if isinstance(v, int) and isinstance(r, int):
+                # Allow for rounding in the device (e.g. mireds).
+                if abs(r - v) > 2:
+                    return False
+            elif r != v:
+                return False
+        return True
+
+    def _sent(self, message, sent):
+        expected = {k: v for k, v in message.items() if k in REPORTED_KEYS}
+        self._desire(**expected)
+        # Only track lights that report their state at all.
+        if not self._reported:
+            return
+        if self._pending:
+            expected = dict(self._pending[0], **expected)
+        self._pending = (expected, sent)
+
+    async def start(self):
+        self._task = asyncio.create_task(self.task())
 
-    async def publish(self, message, soft=True):
+    async def stop(self):
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+
+    async def publish(self, message, soft=True, force=False):
         if soft:
             message["transition"] = 1
-        OsramLight.queue.append((self._name, message,))
+        self._attempt = 0
+        OsramLight.queue.append((self, message, force,))
 
-    async def on(self, soft=True):
+    async def on(self, soft=True, force=False):
         await super().on(soft)
         print("light on", self._name)
-        await self.publish({"state": "ON"}, soft)
+        await self.publish({"state": "ON"}, soft, force)
 
-    async def off(self, soft=True):
+    async def off(self, soft=True, force=False):
         await super().off(soft)
-        await self.publish({"state": "OFF"}, soft)
+        await self.publish({"state": "OFF"}, soft, force)
 
     def map_temperature(self):
         return 153 + (self._temperature - TEMP_COOL) * (370 - 153) // (TEMP_WARM - TEMP_COOL)
         # 153 and 370
         #2400 4200
 
-    async def temperature(self, temperature):
+    async def temperature(self, temperature, force=False):
         await super().temperature(temperature)
-        await self.publish({"color_temp": self.map_temperature()})
+        await self.publish({"color_temp": self.map_temperature()}, force=force)
 
     def map_brightness(self):
         if not self._on or self._level == 0:
@@ -45,40 +111,90 @@ class OsramLight(Light):
             return 1
         return 1 + (self._level - LEVEL_ALL) * 253 // (LEVEL_MAX - LEVEL_ALL)
 
-    async def level(self, level=None, delta=None, soft=True, toggle=False):
+    async def level(self, level=None, delta=None, soft=True, toggle=False, force=False):
         await super().level(level=level, delta=delta, soft=soft, toggle=toggle)
-        await self.publish({"brightness": self.map_brightness()}, soft)
+        await self.publish({"brightness": self.map_brightness()}, soft, force)
 
     @staticmethod
-    async def send_to_group(hazard, members, message):
+    async def send_to_group(hazard, members, message, optional=()):
         if not members:
             return
         print("send to group:", members, message)
         plugin = hazard.find_plugin("ZigBee2MqttPlugin")
-        group = plugin.find_group_by_members(members)
-        if group:
+        groups, individuals = plugin.plan_publish(members, optional)
+        for group in groups:
             print("found group", group)
             await plugin.publish(f"zigbee2mqtt/{group}/set", message)
-        else:
-            print("individual", members)
-            for name in members:
-                await plugin.publish(f"zigbee2mqtt/{name}/set", message)
-                await asyncio.sleep(0.1)
+        if individuals:
+            print("individual", individuals)
+        for name in individuals:
+            await plugin.publish(f"zigbee2mqtt/{name}/set", message)
+            await asyncio.sleep(0.1)
 
     @staticmethod
     async def flush(hazard):
         print("flush osram lights")
         q = OsramLight.queue
         OsramLight.queue = []
-        last_message = {}
-        members = set()
-        for name, message in q:
-            if message == last_message:
-                members.add(name)
+
+        # Merge everything queued for each device into one message (later
+        # keys win), then send each distinct message once to all the devices
+        # that need it.
+        merged = {}
+        forced = set()
+        for light, message, force in q:
+            merged.setdefault(light, {}).update(message)
+            if force:
+                forced.add(light)
+        by_message = {}
+        for light, message in merged.items():
+            key = json.dumps(message, sort_keys=True)
+            if key not in by_message:
+                by_message[key] = (message, set(), set())
+            # Lights that have already reported being in this state don't
+            # need the message, but may still be included in a group if that
+            # saves publishes. A partial match is sent in full so that it can
+            # still be grouped.
+            if light not in forced and light._is_reported(**{k: v for k, v in message.items() if k != "transition"}):
+                light._suppress()
+                by_message[key][2].add(light.name())
             else:
-                if members:
-                    await OsramLight.send_to_group(hazard, members, last_message)
-                members = set([name])
-                last_message = message
-        if members:
-            await OsramLight.send_to_group(hazard, members, last_message)
+                by_message[key][1].add(light.name())
+        sent = time.monotonic()
+        lights = []
+        for message, members, optional in by_message.values():
+            await OsramLight.send_to_group(hazard, members, message, optional)
+            for name in members:
+                light = hazard.find_thing(name)
+                light._sent(message, sent)
+                lights.append(light)
+
+        if any(light._pending for light in lights):
+            task = asyncio.create_task(OsramLight.reconcile(hazard, lights, sent))
+            OsramLight.reconcile_tasks.add(task)
+            task.add_done_callback(OsramLight.reconcile_tasks.discard)
+
+    @staticmethod
+    async def reconcile(hazard, lights, sent):
+        await asyncio.sleep(RECONCILE_DEADLINE)
+        retry = False
+        for light in lights:
+            # Confirmed, or superseded by a later command (which will be
+            # reconciled separately).
+            if not light._pending or light._pending[1] != sent:
+                continue
+            if light._attempt >= RECONCILE_RETRIES:
+                LOG.warning('Light "%s" did not confirm %s', light.name(), light._pending[0])
+                UNCONFIRMED.labels(light.name()).inc()
+                light._pending = None
+                # Fall back to whatever the light last reported.
+                light._desired.clear()
+                continue
+            LOG.info('Retrying "%s" (%s)', light.name(), light._pending[0])
+            light._attempt += 1
+            RETRIES.labels(light.name()).inc()
+            OsramLight.queue.append((light, dict(light._pending[0]), True,))
+            retry = True
+        if retry:
+            # Resending all together lets the retries share group messages.
+            await OsramLight.flush(hazard)
@@ -26,7 +26,7 @@ class SmartenItSwitch(Switch):
         plugin = self._hazard.find_plugin("ZigBee2MqttPlugin")
         async for message in plugin.topic_messages(f"zigbee2mqtt/{self._name}"):
             print(self._name, message.payload.decode())
-            message = json.loads(message.payload)
+            message = message.json or {}
             if "action" in message:
                 await self.dispatch_action(message)
             if "battery_low" in message:
@@ -18,7 +18,7 @@ class SmartThingsDoorSensor(DoorSensor):
         plugin = self._hazard.find_plugin("ZigBee2MqttPlugin")
         async for message in plugin.topic_messages(f"zigbee2mqtt/{self._name}"):
             print(self._name, message.payload.decode())
-            message = json.loads(message.payload)
+            message = message.json or {}
             if "contact" in message:
                 await self.invoke(not message["contact"])
             if "battery" in message:
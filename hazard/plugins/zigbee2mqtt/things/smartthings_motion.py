@@ -18,7 +18,7 @@ class SmartThingsMotionSensor(MotionSensor):
         plugin = self._hazard.find_plugin("ZigBee2MqttPlugin")
         async for message in plugin.topic_messages(f"zigbee2mqtt/{self._name}"):
             print(self._name, message.payload.decode())
-            message = json.loads(message.payload)
+            message = message.json or {}
             if "occupancy" in message:
                 await self.invoke(message["occupancy"])
             if "battery" in message:
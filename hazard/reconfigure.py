@@ -0,0 +1,79 @@
+import async_timeout
+import asyncio
+import logging
+import time
+
+LOG = logging.getLogger("hazard")
+
+# Maximum number of things being reconfigured at once on each transport.
+RECONFIGURE_CONCURRENCY = 4
+
+# Seconds to allow each thing to reconfigure.
+RECONFIGURE_TIMEOUT = 60
+
+
+class ReconfigureJob:
+    def __init__(self, hazard, things):
+        self._hazard = hazard
+        self._things = list(things)
+        self._results = {
+            t.id(): {"id": t.id(), "name": t.name(), "status": "pending"}
+            for t in self._things
+        }
+        self._semaphores = {}
+        self._task = None
+        self._start = None
+        self._end = None
+
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        self._start = time.monotonic()
+        self._task = asyncio.create_task(self._run())
+
+    def _transport(self, thing):
+        # Things provided by the same plugin share the same radio/broker.
+        deps = self._hazard._thing_dependencies(thing)
+        transport = deps[0] if deps else ""
+        if transport not in self._semaphores:
+            self._semaphores[transport] = asyncio.Semaphore(RECONFIGURE_CONCURRENCY)
+        return self._semaphores[transport]
+
+    async def _reconfigure(self, thing):
+        result = self._results[thing.id()]
+        async with self._transport(thing):
+            result["status"] = "running"
+            start = time.monotonic()
+            try:
+                async with async_timeout.timeout(RECONFIGURE_TIMEOUT):
+                    await thing.reconfigure()
+                result["status"] = "done"
+            except asyncio.TimeoutError:
+                LOG.error('Timeout reconfiguring "%s"', thing.name())
+                result["status"] = "timeout"
+            except Exception as e:
+                LOG.exception('Error reconfiguring "%s"', thing.name())
+                result["status"] = "error"
+                result["error"] = "{}: {}".format(type(e).__name__, e)
+            result["duration"] = time.monotonic() - start
+
+    async def _run(self):
+        LOG.info("Reconfiguring %d things", len(self._things))
+        await asyncio.gather(*(self._reconfigure(t) for t in self._things))
+        self._end = time.monotonic()
+        LOG.info("Reconfigure finished in %.1fs", self._end - self._start)
+
+    def to_json(self):
+        counts = {}
+        for r in self._results.values():
+            counts[r["status"]] = counts.get(r["status"], 0) + 1
+        return {
+            "type": type(self).__name__,
+            "json_type": "ReconfigureJob",
+            "running": self.running(),
+            "total": len(self._results),
+            "counts": counts,
+            "elapsed": ((self._end or time.monotonic()) - self._start) if self._start else 0,
+            "results": list(self._results.values()),
+        }
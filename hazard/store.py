@@ -0,0 +1,276 @@
+import json
+import logging
+import os
+
+LOG = logging.getLogger("hazard")
+
+
+class JsonFileStore:
+    def __init__(self, path):
+        self._path = path
+        # Last written things and actions by id, so that write_changes only
+        # needs to be given the ones that changed.
+        self._things = {}
+        self._actions = {}
+
+    def path(self):
+        return self._path
+
+    def read(self):
+        with open(self._path, "r") as f:
+            config = json.load(f)
+        self._prime(config)
+        return config
+
+    def _prime(self, config):
+        self._things = {t["id"]: t for t in config.get("things", [])}
+        self._actions = {a["id"]: a for a in config.get("actions", [])}
+
+    def write(self, config):
+        # Runs in an executor, so must not touch any live hazard state.
+        self._prime(config)
+        data = json.dumps(config, indent=2)
+        _write_atomic(self._path, data)
+
+    def write_changes(self, config, changed):
+        # config has just the plugins and state. changed maps ("thing" or
+        # "action", id) to its JSON, or None if it was removed.
+        _apply_changes(self._things, self._actions, changed)
+        config = {
+            "plugins": config["plugins"],
+            "things": sorted(self._things.values(), key=lambda t: (t["type"], t["name"])),
+            "actions": list(self._actions.values()),
+            "state": config["state"],
+        }
+        _write_atomic(self._path, json.dumps(config, indent=2))
+
+
+def _apply_changes(things, actions, changed):
+    for (kind, id), value in changed.items():
+        objs = things if kind == "thing" else actions
+        if value is None:
+            objs.pop(id, None)
+        else:
+            objs[id] = value
+
+
+def _write_atomic(path, data):
+    # Write to a temporary file and rename it over the original so that a
+    # crash mid-write never leaves a truncated config behind.
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    _fsync_dir(path)
+
+
+def _fsync_dir(path):
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+# Number of journal records to accumulate before compacting into a snapshot.
+COMPACT_AFTER = 1000
+
+
+def _entities_from_config(config):
+    # Flatten a config into independently-updatable entities, keyed by
+    # (kind, plugin, id). The zigbee network table is split out per device and
+    # group so that a single addr16 change is a single journal record.
+    entities = {}
+    for p in config.get("plugins", []):
+        p = dict(p)
+        network = p.pop("network", None)
+        entities[("plugin", "", p["type"])] = p
+        if network is not None:
+            entities[("network", p["type"], "")] = {}
+            for d in network.get("devices", []):
+                entities[("device", p["type"], d["addr64"])] = d
+            for g in network.get("groups", []):
+                entities[("group", p["type"], str(g["addr16"]))] = g
+    for t in config.get("things", []):
+        entities[("thing", "", str(t["id"]))] = t
+    for a in config.get("actions", []):
+        entities[("action", "", str(a["id"]))] = a
+    for k, v in config.get("state", {}).items():
+        entities[("state", "", k)] = v
+    return entities
+
+
+def _config_from_entities(entities):
+    config = {
+        "plugins": [],
+        "things": [],
+        "actions": [],
+        "state": {},
+    }
+    plugins = {}
+    for (kind, plugin, key), value in entities.items():
+        if kind == "plugin":
+            plugins[key] = dict(value)
+            config["plugins"].append(plugins[key])
+        elif kind == "thing":
+            config["things"].append(value)
+        elif kind == "action":
+            config["actions"].append(value)
+        elif kind == "state":
+            config["state"][key] = value
+    for (kind, plugin, key), value in entities.items():
+        if plugin not in plugins:
+            continue
+        network = plugins[plugin].setdefault("network", {"devices": [], "groups": []})
+        if kind == "device":
+            network["devices"].append(value)
+        elif kind == "group":
+            network["groups"].append(value)
+    return config
+
+
+class JournalStore:
+    def __init__(self, path, compact_after=COMPACT_AFTER):
+        self._path = path
+        self._journal_path = path + ".journal"
+        self._compact_after = compact_after
+        self._generation = 0
+        self._journal_len = 0
+        # Last written value of each entity, and the keys of each kind, used to
+        # find what changed.
+        self._entities = {}
+        self._kinds = {}
+        # Set if the journal on disk can't be safely appended to.
+        self._compact_pending = True
+
+    def path(self):
+        return self._path
+
+    def read(self):
+        try:
+            with open(self._path, "r") as f:
+                snapshot = json.load(f)
+        except FileNotFoundError:
+            snapshot = {}
+        self._generation = snapshot.get("generation", 0)
+        entities = _entities_from_config(snapshot)
+
+        self._journal_len = 0
+        self._compact_pending = False
+        try:
+            with open(self._journal_path, "r") as f:
+                header = None
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Torn write at the end of the journal.
+                        LOG.warning("Ignoring truncated journal record")
+                        self._compact_pending = True
+                        break
+                    if header is None:
+                        header = record
+                        if header.get("generation", None) != self._generation:
+                            # Left over from before the last compaction.
+                            LOG.warning("Ignoring stale journal")
+                            self._compact_pending = True
+                            break
+                        continue
+                    key = tuple(record["key"])
+                    if record["op"] == "put":
+                        entities[key] = record["value"]
+                    else:
+                        entities.pop(key, None)
+                    self._journal_len += 1
+        except FileNotFoundError:
+            pass
+
+        LOG.info("Loaded snapshot + %d journal records", self._journal_len)
+        self._entities = {}
+        self._kinds = {}
+        for k, v in entities.items():
+            self._put(k, v)
+        return _config_from_entities(entities)
+
+    def _put(self, key, value):
+        self._entities[key] = value
+        self._kinds.setdefault(key[0], set()).add(key)
+
+    def _del(self, key):
+        del self._entities[key]
+        self._kinds[key[0]].discard(key)
+
+    def write(self, config):
+        # Runs in an executor, so must not touch any live hazard state.
+        self._write(_entities_from_config(config), ())
+
+    def write_changes(self, config, changed):
+        # config has just the plugins and state (which are small, so always
+        # passed in full). changed maps ("thing" or "action", id) to its JSON,
+        # or None if it was removed -- unchanged things and actions aren't
+        # passed at all.
+        entities = _entities_from_config(config)
+        for (kind, id), value in changed.items():
+            entities[(kind, "", str(id))] = value
+        self._write(entities, ("thing", "action"))
+
+    def _write(self, entities, partial_kinds):
+        # Entities of partial_kinds that aren't given are unchanged. Anything
+        # else missing has been removed.
+        records = []
+        for k, v in entities.items():
+            if v is None:
+                if k in self._entities:
+                    records.append({"op": "del", "key": k})
+            elif k not in self._entities or self._entities[k] != v:
+                records.append({"op": "put", "key": k, "value": v})
+        for kind, keys in self._kinds.items():
+            if kind not in partial_kinds:
+                records.extend({"op": "del", "key": k} for k in keys if k not in entities)
+
+        for r in records:
+            if r["op"] == "put":
+                self._put(r["key"], r["value"])
+            else:
+                self._del(r["key"])
+
+        if self._compact_pending or self._journal_len + len(records) > self._compact_after:
+            self._compact()
+            return
+        if not records:
+            return
+
+        try:
+            with open(self._journal_path, "a") as f:
+                if self._journal_len == 0 and f.tell() == 0:
+                    f.write(json.dumps({"generation": self._generation}) + "\n")
+                for r in records:
+                    f.write(json.dumps(r) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+        except Exception:
+            # The in-memory entities are already updated, so get them onto
+            # disk with a full snapshot next time.
+            self._compact_pending = True
+            raise
+        self._journal_len += len(records)
+
+    def _compact(self):
+        LOG.info("Compacting config journal (%d records)", self._journal_len)
+        self._compact_pending = True
+        self._generation += 1
+        config = _config_from_entities(self._entities)
+        config["generation"] = self._generation
+        _write_atomic(self._path, json.dumps(config, indent=2))
+        # The new snapshot has a new generation, so if we crash before the
+        # journal is reset the old journal will be ignored on the next read.
+        _write_atomic(self._journal_path, json.dumps({"generation": self._generation}) + "\n")
+        self._journal_len = 0
+        self._compact_pending = False
@@ -53,11 +53,27 @@ class Thing:
         self._location = {"x": 0, "y": 0}
         self._battery = 0
 
+    def __setattr__(self, name, value):
+        # State is updated by assignment all over the place (e.g. frame
+        # handlers), so any assignment marks the thing as possibly changed and
+        # hazard re-serializes it to see if its version needs to move. Code
+        # that mutates state in place must call _hazard._mark_changed itself.
+        # Renames (which don't all go through load_json, e.g. things created
+        # from a device) also keep hazard's name index up to date.
+        old_name = self.__dict__.get("_name", None)
+        object.__setattr__(self, name, value)
+        hazard = self.__dict__.get("_hazard", None)
+        if hazard is not None:
+            if name == "_name" and value != old_name:
+                hazard._rename_thing(self, old_name)
+            hazard._mark_changed(self)
+
     def load_json(self, json):
         self._id = json.get("id", None)
         self._name = json.get("name", "(unknown)")
         self._zone = json.get("zone", "Home")
         self._location = json.get("location", {"x": 0, "y": 0})
+        self._hazard._mark_changed(self)
 
     def to_json(self):
         return {
@@ -83,9 +99,14 @@ class Thing:
     def _features(self):
         return []
 
+    def _handlers(self):
+        return {}
+
     async def action(self, action, data):
         print("action", action, data)
         await getattr(self, action)(**data)
+        # In case the action only mutated nested state.
+        self._hazard._mark_changed(self)
 
     def remove(self):
         self._hazard.remove_thing(self)
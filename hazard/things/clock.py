@@ -1,3 +1,4 @@
+from hazard.handler import load_policy, POLICY_PARALLEL
 from hazard.thing import Thing, register_thing
 
 import asyncio
@@ -13,6 +14,7 @@ class Clock(Thing):
         self._name = "Clock"
         self._interval = 10
         self._code = ""
+        self._policy = POLICY_PARALLEL
         loop = asyncio.get_event_loop()
         loop.create_task(self._tick())
 
@@ -23,6 +25,7 @@ class Clock(Thing):
         super().load_json(json)
         self._interval = json.get("interval", 10)
         self._code = json.get("code", "")
+        self._policy = load_policy(json)
 
     def to_json(self):
         json = super().to_json()
@@ -30,13 +33,19 @@ class Clock(Thing):
             {
                 "interval": self._interval,
                 "code": self._code,
+                "policy": self._policy,
             }
         )
         return json
 
+    def _handlers(self):
+        return {
+            "code": self._code,
+        }
+
     async def _tick(self):
         while True:
             # print('tick')
             await asyncio.sleep(self._interval)
             # LOG.info('Clock tick')
-            await self._hazard.execute(self._code)
+            await self._hazard.execute(self._code, self, "code", self._policy)
@@ -3,6 +3,7 @@ import asyncio
 import json
 import logging
 
+from hazard.handler import load_policy, POLICY_PARALLEL
 from hazard.thing import Thing, register_thing
 
 
@@ -15,11 +16,14 @@ class DoorSensor(Thing):
         super().__init__(hazard)
         self._open = ""
         self._close = ""
+        self._policy = POLICY_PARALLEL
+        self._is_open = False
 
     def load_json(self, obj):
         super().load_json(obj)
         self._open = obj.get("open", "")
         self._close = obj.get("close", "")
+        self._policy = load_policy(obj)
 
     def to_json(self):
         obj = super().to_json()
@@ -28,6 +32,8 @@ class DoorSensor(Thing):
                 "json_type": "DoorSensor",
                 "open": self._open,
                 "close": self._close,
+                "policy": self._policy,
+                "is_open": self._is_open,
             }
         )
         return obj
@@ -37,6 +43,16 @@ class DoorSensor(Thing):
             "door",
         ]
 
+    def _handlers(self):
+        return {
+            "open": self._open,
+            "close": self._close,
+        }
+
     async def invoke(self, is_open):
         LOG.info('Invoking door open/close "%s/%s"', self._name, is_open)
-        await self._hazard.execute(self._open if is_open else self._close)
+        self._is_open = bool(is_open)
+        if is_open:
+            await self._hazard.execute(self._open, self, "open", self._policy)
+        else:
+            await self._hazard.execute(self._close, self, "close", self._policy)
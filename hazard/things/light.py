@@ -3,9 +3,12 @@ import logging
 import math
 
 from hazard.thing import Thing, register_thing
+import hazard.metrics
 
 LOG = logging.getLogger("hazard")
 
+SUPPRESSED = hazard.metrics.counter("hazard_light_commands_suppressed_total", "Light commands not sent because the light already reported that state.", ["thing"])
+
 # Level:
 # 0: All off
 # 1: Single bulb
@@ -53,12 +56,45 @@ class Light(Thing):
         self._temperature = None
         self._saturation = None
         self._on_level = LEVEL_ALL
+        # Last state confirmed by the device itself, and state that has been
+        # commanded but not yet confirmed (both in device units). Used to
+        # avoid sending commands that wouldn't change anything.
+        self._reported = {}
+        self._desired = {}
+
+    def _report(self, **attrs):
+        self._reported.update(attrs)
+        for k, v in attrs.items():
+            if self._desired.get(k, None) == v:
+                del self._desired[k]
+
+    def _desire(self, **attrs):
+        self._desired.update(attrs)
+
+    def _forget(self, *keys):
+        # For commands whose outcome isn't known (e.g. toggle), so that the
+        # next command is sent rather than checked against stale state.
+        for k in keys:
+            self._reported.pop(k, None)
+            self._desired.pop(k, None)
+
+    def _is_reported(self, **attrs):
+        # True only if the device has reported this state and there's no
+        # in-flight command that would change it (e.g. a quick off then on).
+        return all(
+            k in self._reported and self._reported[k] == v and self._desired.get(k, v) == v
+            for k, v in attrs.items()
+        )
+
+    def _suppress(self):
+        LOG.info('Suppressing redundant command to "%s"', self._name)
+        SUPPRESSED.labels(self._name).inc()
 
-    async def on(self, soft=True):
+    async def on(self, soft=True, force=False):
         self._on = True
         LOG.info('Setting "%s" to ON', self._name)
 
-    async def off(self, soft=True):
+    async def off(self, soft=True, force=False):
         self._on = False
         LOG.info('Setting "%s" to OFF', self._name)
 
@@ -66,7 +102,7 @@ class Light(Thing):
         self._on = not self._on
         LOG.info('Setting "%s" to %s', self._name, "ON" if self._on else "OFF")
 
-    async def level(self, level=None, delta=None, soft=True, toggle=False):
+    async def level(self, level=None, delta=None, soft=True, toggle=False, force=False):
         if delta is not None:
             level = self._level + delta
 
@@ -91,7 +127,7 @@ class Light(Thing):
         self._on = self._level >= self._on_level
         LOG.info('Setting "%s" level to %d', self._name, self._level)
 
-    async def temperature(self, temperature):
+    async def temperature(self, temperature, force=False):
         LOG.info(f'Setting "{self._name}" temperature to {temperature}')
         self._temperature = temperature
 
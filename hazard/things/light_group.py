@@ -8,6 +8,9 @@ from hazard.things.light import Light, LEVEL_OFF, LEVEL_MIN, LEVEL_ALL, LEVEL_MA
 
 LOG = logging.getLogger("hazard")
 
+# Maximum number of member operations in flight at once for each group.
+MEMBER_CONCURRENCY = 8
+
 
 @register_thing
 class LightGroup(Light):
@@ -15,51 +18,67 @@ class LightGroup(Light):
         super().__init__(hazard)
         self._thing_names = []
         self._on_level = LEVEL_OFF
+        self._things = None
+        self._things_version = None
+        self._semaphore = asyncio.Semaphore(MEMBER_CONCURRENCY)
 
-    async def on(self, soft=True):
+    async def on(self, soft=True, force=False):
         LOG.info('Setting group "%s" to ON', self._name)
         await super().on(soft=soft)
-        for d in self.things():
-            await d.on(soft=soft)
+        await self._each(lambda d: d.on(soft=soft, force=force))
 
     def things(self):
-        for t in self._thing_names:
-            yield self._hazard.find_thing(t)
-
-    async def off(self, soft=True):
+        # Resolved once and cached until things are added, removed or renamed.
+        if self._things is None or self._things_version != self._hazard._things_version:
+            self._things = []
+            for t in self._thing_names:
+                try:
+                    self._things.append(self._hazard.find_thing(t))
+                except ValueError:
+                    LOG.error('Unknown thing "%s" in group "%s"', t, self._name)
+            self._things_version = self._hazard._things_version
+        return self._things
+
+    async def _each(self, fn):
+        # Run fn on every member concurrently, so one slow or failing member
+        # doesn't hold up the others.
+        async def run(d):
+            async with self._semaphore:
+                try:
+                    await fn(d)
+                except Exception:
+                    LOG.exception('Error updating "%s" in group "%s"', d.name(), self._name)
+
+        await asyncio.gather(*(run(d) for d in self.things()))
+
+    async def off(self, soft=True, force=False):
         await super().off()
-        for d in self.things():
-            await d.off()
+        await self._each(lambda d: d.off(force=force))
 
     async def toggle(self):
         await super().toggle()
-        for d in self.things():
-            if self._on:
-                await d.on()
-            else:
-                await d.off()
+        if self._on:
+            await self._each(lambda d: d.on())
+        else:
+            await self._each(lambda d: d.off())
 
-    async def level(self, level=None, delta=None, soft=True, toggle=False):
+    async def level(self, level=None, delta=None, soft=True, toggle=False, force=False):
         await super().level(level=level, delta=delta, soft=soft, toggle=toggle)
         LOG.info(f'Setting group "{self._name}" level to {self._level}')
 
-        for d in self.things():
-            await d.level(level=self._level, soft=soft)
+        await self._each(lambda d: d.level(level=self._level, soft=soft, force=force))
 
     async def hue(self, hue=None, delta=None):
         await super().hue(hue, delta)
-        for d in self.things():
-            await d.hue(self._hue)
+        await self._each(lambda d: d.hue(self._hue))
 
-    async def temperature(self, temperature):
+    async def temperature(self, temperature, force=False):
         await super().temperature(temperature)
-        for d in self.things():
-            await d.temperature(self._temperature)
+        await self._each(lambda d: d.temperature(self._temperature, force=force))
 
     async def saturation(self, saturation):
         await super().saturation(saturation)
-        for d in self.things():
-            await d.saturation(self._saturation)
+        await self._each(lambda d: d.saturation(self._saturation))
 
     def temperature_range(self):
         t = [d._temperature for d in self.things() if d._temperature is not None]
@@ -81,6 +100,7 @@ class LightGroup(Light):
     def load_json(self, obj):
         super().load_json(obj)
         self._thing_names = obj.get("things", [])
+        self._things = None
 
     def _features(self):
         return super()._features() + ["group"]
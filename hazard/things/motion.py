@@ -3,6 +3,7 @@ import asyncio
 import json
 import logging
 
+from hazard.handler import load_policy, POLICY_PARALLEL
 from hazard.thing import Thing, register_thing
 
 
@@ -15,11 +16,14 @@ class MotionSensor(Thing):
         super().__init__(hazard)
         self._active = ""
         self._inactive = ""
+        self._policy = POLICY_PARALLEL
+        self._is_active = False
 
     def load_json(self, obj):
         super().load_json(obj)
         self._active = obj.get("active", "")
         self._inactive = obj.get("inactive", "")
+        self._policy = load_policy(obj)
 
     def to_json(self):
         obj = super().to_json()
@@ -28,6 +32,8 @@ class MotionSensor(Thing):
                 "json_type": "MotionSensor",
                 "active": self._active,
                 "inactive": self._inactive,
+                "policy": self._policy,
+                "is_active": self._is_active,
             }
         )
         return obj
@@ -37,6 +43,16 @@ class MotionSensor(Thing):
             "motion",
         ]
 
+    def _handlers(self):
+        return {
+            "active": self._active,
+            "inactive": self._inactive,
+        }
+
     async def invoke(self, is_active):
         LOG.info('Invoking motion "%s/%s"', self._name, is_active)
-        await self._hazard.execute(self._active if is_active else self._inactive)
+        self._is_active = bool(is_active)
+        if is_active:
+            await self._hazard.execute(self._active, self, "active", self._policy)
+        else:
+            await self._hazard.execute(self._inactive, self, "inactive", self._policy)
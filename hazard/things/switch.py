@@ -4,6 +4,7 @@ import json
 import logging
 import time
 
+from hazard.handler import load_policy, POLICY_PARALLEL
 from hazard.thing import Thing, register_thing
 
 
@@ -21,6 +22,7 @@ class SwitchButton:
         self._single = ""
         self._double = ""
         self._hold = ""
+        self._policy = POLICY_PARALLEL
         self._waiting_for_double = None
 
     def load_json(self, obj):
@@ -30,6 +32,7 @@ class SwitchButton:
         self._single = obj.get("single", "")
         self._double = obj.get("double", "")
         self._hold = obj.get("hold", "")
+        self._policy = load_policy(obj)
 
     def to_json(self):
         return {
@@ -41,6 +44,7 @@ class SwitchButton:
             "single": self._single,
             "double": self._double,
             "hold": self._hold,
+            "policy": self._policy,
         }
 
     def name(self):
@@ -49,6 +53,14 @@ class SwitchButton:
     def code(self):
         return self._code
 
+    def _handlers(self):
+        return {
+            "tap": self._tap,
+            "single": self._single,
+            "double": self._double,
+            "hold": self._hold,
+        }
+
     async def _invoke_task(self):
         if not self._double:
             if await self.tap():
@@ -76,21 +88,26 @@ class SwitchButton:
         LOG.info('Invoking "%s/%s" %f', self._switch._name, self._name, time.monotonic())
         asyncio.create_task(self._invoke_task())
 
+    async def _execute(self, code, handler):
+        return await self._switch._hazard.execute(
+            code, self._switch, "{}/{}".format(self._name, handler), self._policy
+        )
+
     async def tap(self):
         LOG.info('Tap on "%s/%s"', self._switch._name, self._name)
-        return await self._switch._hazard.execute(self._tap)
+        return await self._execute(self._tap, "tap")
 
     async def single(self):
         LOG.info('Single tap on "%s/%s"', self._switch._name, self._name)
-        return await self._switch._hazard.execute(self._single)
+        return await self._execute(self._single, "single")
 
     async def double(self):
         LOG.info('Double tap on "%s/%s"', self._switch._name, self._name)
-        return await self._switch._hazard.execute(self._double)
+        return await self._execute(self._double, "double")
 
     async def hold(self):
         LOG.info('Hold on "%s/%s"', self._switch._name, self._name)
-        return await self._switch._hazard.execute(self._hold)
+        return await self._execute(self._hold, "hold")
 
 
 @register_thing
@@ -120,6 +137,13 @@ class Switch(Thing):
     def _features(self):
         return super()._features() + ["switch",]
 
+    def _handlers(self):
+        handlers = super()._handlers()
+        for b in self._buttons:
+            for n, code in b._handlers().items():
+                handlers["{}/{}".format(b.name(), n)] = code
+        return handlers
+
     def get_button(self, code, create=True):
         for btn in self._buttons:
             if btn.code() == code:
@@ -127,6 +151,8 @@ class Switch(Thing):
         if create:
             btn = SwitchButton(self, code)
             self._buttons.append(btn)
+            # Appending isn't seen by Thing.__setattr__.
+            self._hazard._mark_changed(self)
             self._hazard.save()
             return btn
         else:
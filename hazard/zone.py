@@ -0,0 +1,141 @@
+import asyncio
+import collections
+import logging
+
+LOG = logging.getLogger("hazard")
+
+# Commands that can be sent to every light in a zone.
+ZONE_ACTIONS = ("on", "off", "level", "temperature")
+
+
+class Zone:
+    # Membership and aggregate state for one zone. Aggregates are updated as
+    # each member's JSON changes, so queries don't need to visit the members.
+    def __init__(self, hazard, name):
+        self._hazard = hazard
+        self._name = name
+        self._things = {}
+        self._contributions = {}
+        self._lights_on = 0
+        self._open_doors = 0
+        self._active_motion = 0
+        # Value -> count, for max/min. Levels and battery percentages only
+        # take a small number of distinct values.
+        self._levels = collections.Counter()
+        self._batteries = collections.Counter()
+
+    def name(self):
+        return self._name
+
+    def things(self):
+        return list(self._things.values())
+
+    def _contribution(self, thing_json):
+        features = thing_json.get("features", [])
+        # Groups are excluded so that lights aren't counted twice.
+        light_on = "light" in features and "group" not in features and bool(thing_json.get("on", False))
+        return (
+            light_on,
+            thing_json.get("level", None) if light_on else None,
+            bool(thing_json.get("is_open", False)),
+            bool(thing_json.get("is_active", False)),
+            thing_json.get("battery", None) if "battery" in features else None,
+        )
+
+    def _apply(self, contribution, n):
+        light_on, level, door_open, motion_active, battery = contribution
+        self._lights_on += n * light_on
+        self._open_doors += n * door_open
+        self._active_motion += n * motion_active
+        for counter, value in ((self._levels, level), (self._batteries, battery)):
+            if value is not None:
+                counter[value] += n
+                if counter[value] <= 0:
+                    del counter[value]
+
+    def _update(self, thing, thing_json):
+        self._things[thing.id()] = thing
+        contribution = self._contribution(thing_json)
+        previous = self._contributions.get(thing, None)
+        if previous == contribution:
+            return
+        if previous:
+            self._apply(previous, -1)
+        self._apply(contribution, 1)
+        self._contributions[thing] = contribution
+
+    def _remove(self, thing):
+        self._things.pop(thing.id(), None)
+        previous = self._contributions.pop(thing, None)
+        if previous:
+            self._apply(previous, -1)
+
+    def lights_on(self):
+        return self._lights_on
+
+    def max_level(self):
+        return max(self._levels) if self._levels else None
+
+    def open_doors(self):
+        return self._open_doors
+
+    def active_motion(self):
+        return self._active_motion
+
+    def min_battery(self):
+        return min(self._batteries) if self._batteries else None
+
+    def lights(self):
+        # Groups are skipped, otherwise their members would be commanded
+        # twice (and members in other zones would be included).
+        lights = []
+        for t in self._things.values():
+            features = self._hazard.serialized(t)[2]["features"]
+            if "light" in features and "group" not in features:
+                lights.append(t)
+        return lights
+
+    async def _each_light(self, fn):
+        # One concurrent pass over the lights. The caller (handler code or
+        # REST) flushes once afterwards, so backends see the whole batch.
+        async def run(t):
+            try:
+                await fn(t)
+            except Exception:
+                LOG.exception('Error updating "%s" in zone "%s"', t.name(), self._name)
+
+        await asyncio.gather(*(run(t) for t in self.lights()))
+
+    async def on(self):
+        LOG.info('Setting zone "%s" to ON', self._name)
+        await self._each_light(lambda t: t.on())
+
+    async def off(self):
+        LOG.info('Setting zone "%s" to OFF', self._name)
+        await self._each_light(lambda t: t.off())
+
+    async def level(self, level):
+        LOG.info('Setting zone "%s" level to %d', self._name, level)
+        await self._each_light(lambda t: t.level(level=level))
+
+    async def temperature(self, temperature):
+        LOG.info('Setting zone "%s" temperature to %d', self._name, temperature)
+        await self._each_light(lambda t: t.temperature(temperature))
+
+    async def action(self, action, data):
+        if action not in ZONE_ACTIONS:
+            raise ValueError('Unknown zone action "{}"'.format(action))
+        await getattr(self, action)(**data)
+
+    def to_json(self):
+        return {
+            "type": type(self).__name__,
+            "json_type": "Zone",
+            "name": self._name,
+            "things": sorted(self._things),
+            "lights_on": self.lights_on(),
+            "max_level": self.max_level(),
+            "open_doors": self.open_doors(),
+            "active_motion": self.active_motion(),
+            "min_battery": self.min_battery(),
+        }